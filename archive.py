@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+#archive.py
+'''
+Local archive of group posts in SQLite. Keeps every post a Manager sees, live
+or historical, so older messages can be read back without paging through
+`get_more`, and tracks which stretches of time are known to be complete.
+'''
+import time
+import sqlite3
+
+from .post import Post, shared_format
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS posts (
+	grp TEXT NOT NULL,
+	unid TEXT NOT NULL,
+	time REAL NOT NULL,
+	user TEXT NOT NULL,
+	name TEXT NOT NULL,
+	post TEXT NOT NULL,
+	session_id INTEGER,
+	mod_id TEXT,
+	ip TEXT,
+	channel INTEGER,
+	badge INTEGER,
+	n_color TEXT,
+	f_color TEXT,
+	f_size INTEGER,
+	f_face TEXT,
+	mentions TEXT,
+	PRIMARY KEY (grp, unid)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS posts_time ON posts (grp, time);
+CREATE INDEX IF NOT EXISTS posts_name ON posts (grp, name, time);
+CREATE TABLE IF NOT EXISTS spans (
+	grp TEXT NOT NULL,
+	start REAL NOT NULL,
+	end REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS spans_grp ON spans (grp);
+'''
+_COLUMNS = ("grp", "unid", "time", "user", "name", "post", "session_id"
+	, "mod_id", "ip", "channel", "badge", "n_color", "f_color", "f_size"
+	, "f_face", "mentions")
+
+def _group_name(group):
+	return getattr(group, "name", group).lower()
+
+class Archive:
+	'''
+	SQLite store of posts at `path`, indexed by group and unid, time and
+	user. Writes are batched and committed at most `flush_delay` seconds after
+	a post is added. Posts older than `retention` seconds, and all but the
+	newest `max_posts` of each group, are removed by `compact`, which runs
+	after every `compact_every` posts added.
+	Queries run on the event loop's thread; keep them to modest ranges.
+	'''
+	_FLUSH_SIZE = 512		#posts buffered before writing without waiting
+
+	def __init__(self, loop, path=":memory:", retention=None, max_posts=None
+	, flush_delay=1, compact_every=10000):
+		self._loop = loop
+		self._db = sqlite3.connect(path)
+		self._db.executescript(_SCHEMA)
+		self.retention = retention
+		self.max_posts = max_posts
+		self.flush_delay = flush_delay
+		self.compact_every = compact_every
+		self._pending = []			#rows not yet written
+		self._flush_handle = None
+		self._added = 0				#posts added since the last compaction
+		self._spans = {}			#group name -> sorted [start, end] lists
+		self._dirty = set()			#groups whose spans changed since the last flush
+		for grp, start, end in self._db.execute(
+		"SELECT grp, start, end FROM spans ORDER BY grp, start"):
+			self._spans.setdefault(grp, []).append([start, end])
+
+	def __len__(self):
+		self.flush()
+		return self._db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+
+	def add(self, group, post):
+		'''Archive `post` of `group`. Posts without a unid are ignored'''
+		if getattr(post, "unid", None) is None:
+			return
+		self._pending.append((_group_name(group), post.unid, post.time
+			, post.user, post.user.lower(), post.post, post.session_id
+			, post.mod_id, post.ip, post.channel, post.badge, *post._format
+			, ','.join(map(str, post.mentions))))
+		if len(self._pending) >= self._FLUSH_SIZE:
+			self.flush()
+		elif self._flush_handle is None:
+			self._flush_handle = self._loop.call_later(self.flush_delay
+				, self.flush)
+
+	def cover(self, group, start, end):
+		'''
+		Record that every post of `group` between `start` and `end` has been
+		archived. Used internally as contiguous history arrives
+		'''
+		if start > end:
+			return
+		name = _group_name(group)
+		spans = self._spans.setdefault(name, [])
+		#the most recent span is the one usually extended
+		if spans and spans[-1][0] <= start <= spans[-1][1]:
+			if end > spans[-1][1]:
+				spans[-1][1] = end
+				self._dirty.add(name)
+			return
+		spans.append([start, end])
+		spans.sort()
+		merged = [spans[0]]
+		for span in spans[1:]:
+			if span[0] <= merged[-1][1]:
+				merged[-1][1] = max(merged[-1][1], span[1])
+			else:
+				merged.append(span)
+		self._spans[name] = merged
+		self._dirty.add(name)
+
+	def covered_from(self, group, when):
+		'''
+		Earliest time from which all posts of `group` up to `when` are known
+		to be archived, or None if `when` isn't in a complete stretch
+		'''
+		for start, end in self._spans.get(_group_name(group), ()):
+			if start <= when <= end:
+				return start
+		return None
+
+	def flush(self):
+		'''Write buffered posts and spans'''
+		if self._flush_handle is not None:
+			self._flush_handle.cancel()
+			self._flush_handle = None
+		if not self._pending and not self._dirty:
+			return
+		pending, self._pending = self._pending, []
+		with self._db:
+			self._db.executemany("INSERT OR IGNORE INTO posts ({}) VALUES ({})"
+				.format(', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS)))
+				, pending)
+			for name in self._dirty:
+				self._db.execute("DELETE FROM spans WHERE grp = ?", (name,))
+				self._db.executemany("INSERT INTO spans VALUES (?, ?, ?)"
+					, ((name, start, end) for start, end in self._spans[name]))
+		self._dirty.clear()
+		self._added += len(pending)
+		if self._added >= self.compact_every:
+			self.compact()
+
+	def compact(self, vacuum=False):
+		'''
+		Apply `retention` and `max_posts`. If `vacuum`, also give the freed
+		space back to the filesystem, which rewrites the whole database
+		'''
+		self.flush()
+		self._added = 0
+		with self._db:
+			if self.retention is not None:
+				#post times are unix epochs, not loop time
+				cutoff = time.time() - self.retention
+				self._db.execute("DELETE FROM posts WHERE time < ?", (cutoff,))
+				self._trim_spans(lambda name: cutoff)
+			if self.max_posts is not None:
+				cutoffs = {}
+				for (name,) in self._db.execute(
+				"SELECT DISTINCT grp FROM posts").fetchall():
+					#time of the oldest post to keep
+					row = self._db.execute("SELECT time FROM posts WHERE grp = ?"
+						" ORDER BY time DESC LIMIT 1 OFFSET ?"
+						, (name, max(0, self.max_posts - 1))).fetchone()
+					if row is not None:
+						cutoffs[name] = row[0]
+						self._db.execute("DELETE FROM posts WHERE grp = ?"
+							" AND time < ?", (name, row[0]))
+				self._trim_spans(cutoffs.get)
+		self.flush()
+		if vacuum:
+			self._db.execute("VACUUM")
+
+	def _trim_spans(self, cutoff_of):
+		'''Drop the parts of spans before each group's cutoff'''
+		for name, spans in self._spans.items():
+			cutoff = cutoff_of(name)
+			if cutoff is None:
+				continue
+			trimmed = [[max(start, cutoff), end] for start, end in spans
+				if end > cutoff]
+			if trimmed != spans:
+				self._spans[name] = trimmed
+				self._dirty.add(name)
+
+	def _posts(self, group, query, args):
+		self.flush()
+		cursor = self._db.execute("SELECT {} FROM posts WHERE {}".format(
+			', '.join(_COLUMNS), query), args)
+		for row in cursor:
+			post = Post.__new__(Post)
+			post.group = group
+			(_, post.unid, post.time, post.user, _, post.post, post.session_id
+				, post.mod_id, post.ip, post.channel, post.badge) = row[:11]
+			post._format = shared_format(*row[11:15])
+			post.mentions = set(row[15].split(',')) if row[15] else set()
+			yield post
+
+	def get(self, group, unid):
+		'''Archived post of `group` with unid `unid`, or None'''
+		return next(self._posts(group, "grp = ? AND unid = ?"
+			, (_group_name(group), unid)), None)
+
+	def range(self, group, start=0, end=float("inf"), newest_first=False):
+		'''
+		Iterator of archived posts of `group` (a Group or group name) posted
+		between `start` and `end`, oldest first unless `newest_first`
+		'''
+		return self._posts(group, "grp = ? AND time >= ? AND time <= ? "
+			"ORDER BY time " + ("DESC" if newest_first else "ASC")
+			, (_group_name(group), start, end))
+
+	def by_user(self, group, user, start=0, end=float("inf"), limit=-1):
+		'''
+		Iterator of archived posts of `group` by `user` (case-insensitive)
+		between `start` and `end`, newest first. At most `limit`, if given
+		'''
+		return self._posts(group, "grp = ? AND name = ? AND time >= ? "
+			"AND time <= ? ORDER BY time DESC LIMIT ?"
+			, (_group_name(group), str(user).lower(), start, end, limit))
+
+	def latest(self, group):
+		'''Time of the newest archived post of `group`, or 0'''
+		self.flush()
+		return self._db.execute("SELECT MAX(time) FROM posts WHERE grp = ?"
+			, (_group_name(group),)).fetchone()[0] or 0
+
+	def close(self):
+		'''Write buffered posts and close the database'''
+		self.flush()
+		self._db.close()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+#bans.py
+'''
+Ban bookkeeping for groups. Bans are indexed so that lookups by message,
+username or IP don't scan the ban list, and are updated from individual
+`blocked`/`unblocked` frames instead of refetching the whole list.
+'''
+import ipaddress
+from collections import abc
+
+class _Node:
+	__slots__ = ("children", "bans")
+	def __init__(self):
+		self.children = {}	#next octet -> _Node
+		self.bans = {}		#unid -> Ban, for every ban below this node
+
+class IPIndex:
+	'''
+	Trie of the octets of banned IP addresses (IPv4 and IPv6 separately), for
+	finding the ban whose address shares the longest prefix with another.
+	Matches shorter than `min_prefix` bits for the address's version are
+	ignored
+	'''
+	def __init__(self, min_prefix=None):
+		self.min_prefix = {4: 24, 6: 48} if min_prefix is None else min_prefix
+		self._roots = {4: _Node(), 6: _Node()}
+
+	def __len__(self):
+		return sum(len(root.bans) for root in self._roots.values())
+
+	@staticmethod
+	def _parse(ip):
+		try:
+			return ipaddress.ip_address(ip)
+		except ValueError:
+			return None
+
+	def add(self, ban):
+		'''Index `ban` by its IP. Bans without a valid IP are ignored'''
+		address = self._parse(ban.ip)
+		if address is None:
+			return
+		node = self._roots[address.version]
+		node.bans[ban.unid] = ban
+		for octet in address.packed:
+			node = node.children.setdefault(octet, _Node())
+			node.bans[ban.unid] = ban
+
+	def remove(self, ban):
+		'''Stop indexing `ban`'''
+		address = self._parse(ban.ip)
+		if address is None:
+			return
+		node = self._roots[address.version]
+		node.bans.pop(ban.unid, None)
+		for octet in address.packed:
+			child = node.children.get(octet)
+			if child is None:
+				return
+			child.bans.pop(ban.unid, None)
+			if not child.bans:
+				#nothing left below
+				del node.children[octet]
+				return
+			node = child
+
+	def clear(self):
+		for root in self._roots.values():
+			root.children.clear()
+			root.bans.clear()
+
+	def match(self, ip):
+		'''
+		2-tuple of the most recent Ban sharing the longest prefix with `ip`
+		and the length of the prefix in bits, or None
+		'''
+		address = self._parse(ip)
+		if address is None:
+			return None
+		node = self._roots[address.version]
+		depth = 0
+		for octet in address.packed:
+			child = node.children.get(octet)
+			if child is None:
+				break
+			node = child
+			depth += 8
+		if not node.bans or depth < self.min_prefix[address.version]:
+			return None
+		return max(node.bans.values(), key=lambda ban: ban.time), depth
+
+class BanStore(abc.Collection):
+	'''
+	Read-only collection of the Bans of a group, indexed by unid, lowercase
+	username and IP. Use `copy` for a snapshot list. Only the group changes
+	it, as ban frames arrive
+	'''
+	def __init__(self):
+		self._by_unid = {}		#unid -> Ban
+		self._by_name = {}		#lowercase username -> {unid: Ban}
+		self._by_ip = {}		#ip -> {unid: Ban}
+		self._prefixes = IPIndex()
+
+	def __len__(self):
+		return len(self._by_unid)
+
+	def __iter__(self):
+		return iter(self._by_unid.values())
+
+	def __contains__(self, ban):
+		return self._by_unid.get(getattr(ban, "unid", ban)) is not None
+
+	def __repr__(self):
+		return "{}({})".format(type(self).__name__, list(self._by_unid.values()))
+
+	def get(self, unid):
+		'''Ban created from message `unid`, or None'''
+		return self._by_unid.get(unid)
+
+	def by_name(self, name):
+		'''Most recent Ban of user `name` (case-insensitive), or None'''
+		bans = self._by_name.get(str(name).lower())
+		return max(bans.values(), key=lambda ban: ban.time) if bans else None
+
+	def by_ip(self, ip):
+		'''List of Bans of IP address `ip`'''
+		return list(self._by_ip.get(ip, {}).values())
+
+	def match_ip(self, ip):
+		'''
+		2-tuple of the Ban whose IP shares the longest prefix with `ip`, and
+		the prefix length in bits, or None. See IPIndex
+		'''
+		return self._prefixes.match(ip)
+
+	def copy(self):
+		'''Snapshot list of Bans'''
+		return list(self._by_unid.values())
+
+	def _add(self, ban):
+		'''Index `ban`, replacing any with the same unid. Used on blocked'''
+		self._remove(ban.unid)
+		self._by_unid[ban.unid] = ban
+		self._by_name.setdefault(str(ban.user).lower(), {})[ban.unid] = ban
+		self._by_ip.setdefault(ban.ip, {})[ban.unid] = ban
+		self._prefixes.add(ban)
+
+	def _remove(self, unid):
+		'''Forget and return the Ban with `unid`, or None. Used on unblocked'''
+		ban = self._by_unid.pop(unid, None)
+		if ban is None:
+			return None
+		for index, key in ((self._by_name, str(ban.user).lower())
+		, (self._by_ip, ban.ip)):
+			bans = index[key]
+			del bans[unid]
+			if not bans:
+				del index[key]
+		self._prefixes.remove(ban)
+		return ban
+
+	def _replace(self, bans):
+		'''Replace every Ban with those in `bans`. Used on blocklist'''
+		self._by_unid.clear()
+		self._by_name.clear()
+		self._by_ip.clear()
+		self._prefixes.clear()
+		for ban in bans:
+			self._add(ban)
@@ -1,4 +1,6 @@
 import asyncio
+from collections import deque, abc
+from functools import partial
 from . import generate
 
 #enumerable constants
@@ -17,20 +19,185 @@ FONT_FACES = [
 FONT_SIZES = [9, 10, 11, 12, 13, 14]
 CHANNEL_NAMES = ["None", "Red", "Blue", "Both"]
 
+class FrameBuffer:
+	'''
+	Incremental splitter for chatango's null-terminated frames.
+	Only bytes that arrived since the last call are scanned for terminators.
+	'''
+	def __init__(self):
+		self._buffer = bytearray()
+		self._scan = 0		#bytes before this index contain no terminator
+
+	def __len__(self):
+		return len(self._buffer)
+
+	def feed(self, data):
+		'''
+		Append `data` and yield 2-tuples of (command, payload) for every complete
+		frame. `command` is bytes, and `payload` is a memoryview of the bytes
+		after the first ':' (or None if there are none) which is only valid until
+		the next iteration.
+		'''
+		buffer = self._buffer
+		buffer += data
+		end = buffer.find(b'\x00', self._scan)
+		if end == -1:
+			self._scan = len(buffer)
+			return
+		start = 0
+		view = memoryview(buffer)
+		try:
+			while end != -1:
+				stop = end
+				#strip trailing \r\n
+				while stop > start and buffer[stop-1] in b"\r\n":
+					stop -= 1
+				colon = buffer.find(b':', start, stop)
+				if colon == -1:
+					yield bytes(view[start:stop]), None
+				else:
+					payload = view[colon+1:stop]
+					yield bytes(view[start:colon]), payload
+					payload.release()
+				start = end + 1
+				end = buffer.find(b'\x00', start)
+		finally:
+			view.release()
+			del buffer[:start]
+			self._scan = len(buffer)
+
+class EventQueue:
+	'''
+	Bounded, ordered queue of handler calls for a single connection.
+	Items are run one after another by a single consumer task. Reading from the
+	transport is paused once `high_water` items are pending and resumed once
+	the queue drains to `low_water`, and isn't paused while something holds it
+	(see `hold`). While above `high_water`, items whose name is in `shed` are
+	dropped instead of queued.
+	'''
+	def __init__(self, protocol, high_water=256, low_water=64, shed=()):
+		if low_water > high_water:
+			raise ValueError("low_water must not exceed high_water")
+		self._protocol = protocol
+		self._queue = deque()
+		self._consumer = None
+		self._paused = False
+		self._holds = 0			#waiters that need frames to keep arriving
+		self.high_water = high_water
+		self.low_water = low_water
+		self.shed = frozenset(shed)
+		self.dropped = 0
+
+	def __len__(self):
+		return len(self._queue)
+
+	paused = property(lambda self: self._paused
+		, doc="Whether reading from the transport is currently paused")
+
+	def put(self, name, func, *args):
+		'''
+		Queue `func(*args)` to run after all items before it. If the call
+		returns an awaitable, it is awaited before the next item runs.
+		'''
+		queue = self._queue
+		if len(queue) >= self.high_water:
+			if name in self.shed:
+				self.dropped += 1
+				return
+			self._pause()
+		queue.append((name, func, args))
+		if self._consumer is None:
+			self._consumer = self._protocol._loop.create_task(self._consume())
+
+	def hold(self):
+		'''
+		Keep reading from the transport until `release`, for code waiting on
+		frames (possibly from inside a queued call, which stops the queue
+		from draining)
+		'''
+		self._holds += 1
+		if self._paused:
+			self._resume()
+
+	def release(self):
+		'''Undo `hold`. Reading pauses again when the next item is queued'''
+		self._holds -= 1
+
+	async def _consume(self):
+		queue = self._queue
+		loop = self._protocol._loop
+		try:
+			while queue:
+				name, func, args = queue.popleft()
+				try:
+					ret = func(*args)
+					if asyncio.iscoroutine(ret):
+						await ret
+				except Exception as exc:
+					loop.call_exception_handler({
+						  "message": "exception in queued call %r" % name
+						, "exception": exc
+					})
+				if self._paused and len(queue) <= self.low_water:
+					self._resume()
+		finally:
+			self._consumer = None
+			if self._paused:
+				self._resume()
+
+	def _pause(self):
+		transport = self._protocol._transport
+		if self._paused or self._holds or transport is None \
+		or transport.is_closing():
+			return
+		self._paused = True
+		transport.pause_reading()
+
+	def _resume(self):
+		self._paused = False
+		transport = self._protocol._transport
+		if transport is not None and not transport.is_closing():
+			transport.resume_reading()
+
 class ChatangoProtocol(asyncio.Protocol):
 	'''Virtual class interpreting chatango's protocol'''
-	_PING_DELAY = 15
-	_LONGEST_PING = 60
+	#event queue bounds and events which can be dropped under load
+	_QUEUE_HIGH_WATER = 256
+	_QUEUE_LOW_WATER = 64
+	_SHED_EVENTS = ()
+	_HANDLERS = {}
+	def __init_subclass__(cls, **kwargs):
+		'''
+		Build the command table once per class. Values are 2-tuples of the
+		`_recv_` function and whether it must be scheduled as a coroutine
+		'''
+		super().__init_subclass__(**kwargs)
+		cls._HANDLERS = {}
+		for name in dir(cls):
+			if not name.startswith("_recv_"):
+				continue
+			handler = getattr(cls, name)
+			cls._HANDLERS[name[6:].encode()] = (handler
+				, asyncio.iscoroutinefunction(handler))
+
 	def __init__(self, manager, storage, loop=None):
 		self._loop = manager.loop if loop is None else loop
 		self._storage = storage
 		self._manager = manager
-		self._ping_task = None
 		#socket stuff
 		self._transport = None
 		self._last_command = -1
-		self._rbuff = b""
+		self._last_write = -1
+		self._ping_sent = None		#time of the unanswered ping, if any
+		self._rtt = None			#seconds between the last ping and its answer
+		self._rbuff = FrameBuffer()
+		self._wbuff = []			#encoded commands waiting for the next flush
+		self._flush_handle = None
+		self._write_paused = False
+		self._drain_waiter = None
 		self.connected = False
+		self._events = EventQueue(self, self._QUEUE_HIGH_WATER
+			, self._QUEUE_LOW_WATER, self._SHED_EVENTS)
 		#session id
 		self._session_id = generate.session_id()
 
@@ -40,70 +207,129 @@ class ChatangoProtocol(asyncio.Protocol):
 
 	def data_received(self, data):
 		'''Parse argument as data from the socket and call method'''
-		self._rbuff += data
-		commands = self._rbuff.split(b'\x00')
-		for command in commands[:-1]:
-			args = command.decode('utf-8').rstrip("\r\n").split(':')
+		handlers = self._HANDLERS
+		for command, payload in self._rbuff.feed(data):
+			handler = handlers.get(command)
+			#only decode frames we have a handler for
+			if handler is None:
+				continue
 			try:
-				#create a task for the recv event
-				receive = getattr(self, "_recv_"+args[0])
-				self._loop.create_task(receive(args[1:]))
-			except AttributeError:
-				pass
-		self._rbuff = commands[-1]
+				args = str(payload, "utf-8").split(':') \
+					if payload is not None else []
+			except UnicodeDecodeError:
+				continue
+			receive, is_coroutine = handler
+			if is_coroutine:
+				#keep ordering with events queued by earlier frames
+				self._events.put(receive.__name__, receive, self, args)
+				continue
+			#synchronous handlers run inline; no task per frame
+			try:
+				receive(self, args)
+			except Exception as exc:
+				self._loop.call_exception_handler({
+					  "message": "exception in handler for %r" % command
+					, "exception": exc
+				})
 		self._last_command = self._loop.time()
+		if self._ping_sent is not None:
+			self._rtt = self._last_command - self._ping_sent
+			self._ping_sent = None
 
 	def connection_made(self, transport):
 		'''Save the transport and set last command time'''
 		self.connected = True
 		self._transport = transport
-		self._last_command = self._loop.time()
-		#create a ping
-		self._ping_task = self._loop.create_task(self.ping())
+		self._last_command = self._last_write = self._loop.time()
+		self._manager._keepalive.add(self)
 
 	def connection_lost(self, exc):
-		'''Cancel the ping task and fire on_connection_error'''
-		if self._ping_task:
-			self._ping_task.cancel()
+		'''Stop keepalives and fire on_connection_error'''
+		self._manager._keepalive.remove(self)
+		self._wbuff.clear()
+		self._wake_drain()
 		if self.connected: #connection lost if the transport closes abruptly
 			self._call_event("on_connection_error", exc)
 
 	#########################################
 
+	def pause_writing(self):
+		'''Transport buffer is full; hold commands until resume_writing'''
+		self._write_paused = True
+
+	def resume_writing(self):
+		'''Transport buffer drained; write held commands'''
+		self._write_paused = False
+		self._flush()
+		self._wake_drain()
+
 	def send_command(self, *args, firstcmd=False):
-		'''Send data to socket'''
+		'''
+		Queue data for the socket. Commands sent in the same loop iteration are
+		coalesced into a single write.
+		'''
 		if self._transport is None:
 			return
 		if firstcmd:
-			self._transport.write(bytes(':'.join(args)+'\x00', "utf-8"))
+			self._wbuff.append(bytes(':'.join(args)+'\x00', "utf-8"))
 		else:
-			self._transport.write(bytes(':'.join(args)+'\r\n\x00', "utf-8"))
+			self._wbuff.append(bytes(':'.join(args)+'\r\n\x00', "utf-8"))
+		if self._flush_handle is None and not self._write_paused:
+			self._flush_handle = self._loop.call_soon(self._flush)
+
+	def _flush(self):
+		'''Write all buffered commands to the transport at once'''
+		if self._flush_handle is not None:
+			self._flush_handle.cancel()
+			self._flush_handle = None
+		if not self._wbuff or self._write_paused \
+		or self._transport is None or self._transport.is_closing():
+			return
+		data = b"".join(self._wbuff) if len(self._wbuff) > 1 else self._wbuff[0]
+		self._wbuff.clear()
+		self._transport.write(data)
+		self._last_write = self._loop.time()
+
+	def _wake_drain(self):
+		if self._drain_waiter is not None:
+			if not self._drain_waiter.done():
+				self._drain_waiter.set_result(None)
+			self._drain_waiter = None
+
+	async def drain(self):
+		'''(Coro) Wait until all sent commands have been handed to the transport'''
+		self._flush()
+		while self._write_paused:
+			if self._transport is None or self._transport.is_closing():
+				raise ConnectionResetError("connection lost")
+			if self._drain_waiter is None:
+				self._drain_waiter = self._loop.create_future()
+			await self._drain_waiter
+		if self._wbuff:
+			raise ConnectionResetError("connection lost")
 
 	def _call_event(self, event, *args, **kw):
-		'''Attempt to call manager's method'''
-		try:
-			event = getattr(self._manager, event)
-			self._loop.create_task(event(self._storage, *args, **kw))
-		except AttributeError:
-			pass
+		'''Queue calls to the manager's handlers for `event`, if it has any'''
+		handlers = self._manager._get_handlers(event)
+		for func in handlers:
+			if kw:
+				func = partial(func, **kw)
+			self._events.put(event, func, self._storage, *args)
 
 	async def disconnect(self, raise_error=False):
 		'''Safely close the transport. Prevents firing on_connection_error 'lost' '''
 		if self._transport is not None:
+			self._flush()
 			self._transport.close()
-		#cancel the ping task now
-		if self._ping_task is not None:
-			self._ping_task.cancel()
-			self._ping_task = None
+		self._manager._keepalive.remove(self)
 		self.connected = raise_error
 		self._call_event("on_disconnect")
 
-	async def ping(self):
-		'''Send a ping to keep the transport alive'''
-		while self._loop.time() - self._last_command < self._LONGEST_PING:
-			await asyncio.sleep(self._PING_DELAY)
-			self.send_command("")
-		self._transport.close()
+	def ping(self):
+		'''Send a ping. The next frame received is taken as its answer'''
+		if self._ping_sent is None:
+			self._ping_sent = self._loop.time()
+		self.send_command("")
 
 class Connection:
 	'''
@@ -123,6 +349,7 @@ class Connection:
 		self._f_size  = 11
 		self._f_color = ""
 		self._f_face  = 0
+		self._header = None		#cached formatting tags, see _post_header
 
 	####################################
 	# Properties
@@ -134,6 +361,8 @@ class Connection:
 		, doc="Main post color formatting.")
 	f_size = property(lambda self: self._f_size
 		, doc="Font size. Limited to integers 9-14")
+	latency = property(lambda self: self._protocol._rtt
+		, doc="Round trip time in seconds of the last keepalive ping, or None")
 	@property
 	def f_face(self):
 		'''Font face. Can be an integer or valid font name.'''
@@ -141,6 +370,13 @@ class Connection:
 			return FONT_FACES[self._f_face]
 		return self._f_face
 
+	def _post_header(self):
+		'''Formatting tags that precede every post, rebuilt only on change'''
+		if self._header is None:
+			self._header = ("<n{0._n_color}/><f x{0._f_size:02d}{0._f_color}="\
+				"\"{0._f_face}\">").format(self)
+		return self._header
+
 	@n_color.setter
 	def n_color(self, arg: str):
 		if self._aid is None:
@@ -149,6 +385,7 @@ class Connection:
 			except ValueError:
 				raise ValueError("n_color must be a valid hex color")
 			self._n_color = arg
+			self._header = None
 
 	@f_color.setter
 	def f_color(self, arg: str):
@@ -158,13 +395,16 @@ class Connection:
 			except ValueError:
 				raise ValueError("f_color must be a valid hex color")
 		self._f_color = arg
+		self._header = None
 
 	@f_size.setter
 	def f_size(self, arg: int):
 		self._f_size = min(22, max(9, arg))
+		self._header = None
 
 	@f_face.setter
 	def f_face(self, arg):
+		self._header = None
 		if isinstance(arg, str):
 			if not arg.isdigit():
 				self._f_face = arg
@@ -172,17 +412,67 @@ class Connection:
 			arg = int(arg)
 		self._f_face = min(len(FONT_FACES), max(0, arg))
 
+class SetView(abc.Set):
+	'''Read-only live view of a set. Use `copy` for a snapshot'''
+	__slots__ = ("_items",)
+	def __init__(self, items):
+		self._items = items
+
+	def __contains__(self, item):
+		return item in self._items
+
+	def __iter__(self):
+		return iter(self._items)
+
+	def __len__(self):
+		return len(self._items)
+
+	def __repr__(self):
+		return "{}({})".format(type(self).__name__, repr(self._items))
+
+	@classmethod
+	def _from_iterable(cls, iterable):
+		#results of set operations are ordinary sets
+		return set(iterable)
+
+	def copy(self):
+		'''Snapshot of the set'''
+		return set(self._items)
+
+class SequenceView(abc.Sequence):
+	'''Read-only live view of a list or deque. Use `copy` for a snapshot'''
+	__slots__ = ("_items",)
+	def __init__(self, items):
+		self._items = items
+
+	def __getitem__(self, index):
+		return self._items[index]
+
+	def __iter__(self):
+		return iter(self._items)
+
+	def __len__(self):
+		return len(self._items)
+
+	def __repr__(self):
+		return "{}({})".format(type(self).__name__, repr(self._items))
+
+	def copy(self):
+		'''Snapshot of the sequence'''
+		return list(self._items)
+
 class Flags:
 	'''Base class that explains bitwise flags and can set/clear them'''
 	_EXPLAIN = []
 	_IMPLIES = {}
+	__slots__ = ("_value",)
 
 	def __init__(self, value: int):
-		self._dict = {}
-		for i, flag in enumerate(self._EXPLAIN):
-			self._dict[2**i] = flag
 		self._value = value
 
+	def __int__(self):
+		return int(self._value)
+
 	def set(self, flag):
 		'''Set a flag and all those implied by it'''
 		if flag in self._IMPLIES:
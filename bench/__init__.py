@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+#__init__.py
+'''
+Benchmarks against a local mock of Chatango's group servers. Run them as
+modules from the directory containing the package, e.g.
+	python -m pytango.bench.sharding
+(using the name of this package's directory). Each takes --help.
+'''
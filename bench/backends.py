@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+#backends.py
+'''
+Frame parsing and dispatch throughput of each event loop backend (see
+manager.new_event_loop), against the mock server. Groups are joined by one
+unsharded Manager, and the time until every group has received its burst of
+posts is measured. Backends that aren't installed are skipped.
+'''
+import time
+import asyncio
+import argparse
+
+from ..manager import new_event_loop
+from .mockserver import MockServer, CountingManager
+
+BACKENDS = ("selector", "uvloop")
+
+def run(backend, groups, port):
+	'''
+	Seconds for `groups` groups to receive their bursts from the mock server
+	on `port`, with event loop backend `backend`
+	'''
+	loop = new_event_loop(backend)
+	manager = CountingManager("", "", loop=loop)
+	done = loop.create_future()
+	finished = set()
+	def on_usercount(group):
+		finished.add(group.name)
+		if len(finished) == groups and not done.done():
+			done.set_result(None)
+	manager.add_event("on_usercount", on_usercount)
+
+	async def main():
+		start = time.perf_counter()
+		await asyncio.gather(*(manager.join_group("bench{}".format(number)
+			, port) for number in range(groups)))
+		await done
+		return time.perf_counter() - start
+
+	try:
+		return loop.run_until_complete(main())
+	finally:
+		manager.stop()
+		loop.close()
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument("--groups", type=int, default=16
+		, help="groups joined (default: 16)")
+	parser.add_argument("--posts", type=int, default=10000
+		, help="posts sent to each group (default: 10000)")
+	parser.add_argument("--rounds", type=int, default=3
+		, help="runs of each backend; the fastest is reported (default: 3)")
+	args = parser.parse_args()
+	total = args.groups * args.posts
+	print("{} groups x {} posts".format(args.groups, args.posts))
+	with MockServer(args.posts) as server:
+		for backend in BACKENDS:
+			try:
+				seconds = min(run(backend, args.groups, server.port)
+					for _ in range(args.rounds))
+			except ValueError as exc:
+				print("{:>10}: skipped ({})".format(backend, exc))
+				continue
+			print("{:>10}: {:7.2f} s {:10.0f} posts/s".format(backend
+				, seconds, total / seconds))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+#memory.py
+'''
+Memory held per Post and per User, measured with tracemalloc. Posts are
+parsed from `b` frame fields and users are joined with one client each, as
+they are from `participant` frames; the frame fields are allocated before
+measuring, so only what the objects keep is counted. Run it on an older
+checkout for before/after figures.
+'''
+import asyncio
+import argparse
+import tracemalloc
+
+from ..manager import Manager
+from ..group import GroupProtocol, User
+from ..post import Post
+
+def measure(build, count):
+	'''Bytes still allocated per object after `build(count)`, and the objects'''
+	tracemalloc.start()
+	before = tracemalloc.take_snapshot()
+	objects = build(count)
+	after = tracemalloc.take_snapshot()
+	tracemalloc.stop()
+	size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+	return size / count, objects
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument("--count", type=int, default=10000
+		, help="posts and users created (default: 10000)")
+	args = parser.parse_args()
+	loop = asyncio.new_event_loop()
+	group = GroupProtocol("bench", Manager("", "", loop=loop), loop=loop)._storage
+
+	frames = [("{}:user{}::{}::{}:10.0.{}.1:0::<n000/><f x11=\"0\">message "
+		"{} for @user{}").format(1500000000 + number / 10, number % 100
+		, 12345678 + number % 100, number, number % 250, number
+		, (number * 7) % 100).split(':') for number in range(args.count)]
+	post_size, _ = measure(lambda count: [Post.normal(group, frames[number])
+		for number in range(count)], args.count)
+
+	names = ["user{}".format(number) for number in range(args.count)]
+	sessions = [str(12345678 + number) for number in range(args.count)]
+	def build_users(count):
+		ret = []
+		for number in range(count):
+			user = group._members.add(User(group, names[number]))
+			group._members.join(user, number, sessions[number], 1500000000.0)
+			ret.append(user)
+		return ret
+	user_size, _ = measure(build_users, args.count)
+
+	print("{:7.0f} bytes per post".format(post_size))
+	print("{:7.0f} bytes per user".format(user_size))
+	loop.close()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#mockserver.py
+'''
+Local stand-in for Chatango's group servers. Every group joined is sent a
+burst of posts as fast as the connection takes them, followed by a user count
+frame that marks the end of the burst. The server runs in its own process, so
+it doesn't compete with the client for the event loop.
+'''
+import asyncio
+import multiprocessing
+
+from ..manager import Manager
+
+_LOGIN = b"ok:owner:1234567890:M:x:1:2:\r\n\x00inited\r\n\x00"
+_POST = '''b:{time}:user{user}::{session}::{pnum}:10.0.{user}.1:0::\
+<n000/><f x11="0">message {pnum} for @user{mention}, with a bit of text\r\n\x00\
+u:{pnum}:{unid}\r\n\x00'''
+
+def burst(posts, users=100):
+	'''Bytes of `posts` paired b/u frames from `users` users, then the end'''
+	return ''.join(_POST.format(time=1500000000 + number / 10
+		, user=number % users, session=12345678 + number % users
+		, pnum=number, mention=(number * 7) % users, unid="U{:08}".format(number))
+		for number in range(posts)).encode() + b"n:ff\r\n\x00"
+
+class _MockGroup(asyncio.Protocol):
+	'''One group connection. Sends the burst after bauth, then ignores input'''
+	def __init__(self, data):
+		self._data = data
+		self._sent = False
+
+	def connection_made(self, transport):
+		self._transport = transport
+
+	def data_received(self, data):
+		if not self._sent and b"bauth" in data:
+			self._sent = True
+			self._transport.write(_LOGIN)
+			self._transport.write(self._data)
+
+def _serve(posts, ports):
+	loop = asyncio.new_event_loop()
+	data = burst(posts)
+	server = loop.run_until_complete(loop.create_server(
+		lambda: _MockGroup(data), "127.0.0.1", 0))
+	ports.put(server.sockets[0].getsockname()[1])
+	loop.run_forever()
+
+class MockServer:
+	'''
+	Mock group server sending `posts` posts to each connection, running in
+	another process while used as a context manager. Join groups with
+	`port` as the port, using LocalManager
+	'''
+	def __init__(self, posts):
+		self.posts = posts
+		self.port = None
+		self._process = None
+
+	def __enter__(self):
+		context = multiprocessing.get_context("spawn")
+		ports = context.Queue()
+		self._process = context.Process(target=_serve, daemon=True
+			, args=(self.posts, ports))
+		self._process.start()
+		self.port = ports.get()
+		return self
+
+	def __exit__(self, *exc_info):
+		self._process.terminate()
+		self._process.join()
+
+class LocalManager(Manager):
+	'''Manager that connects groups to localhost, on the port they're joined with'''
+	async def _connect_group(self, protocol):
+		await self.loop.create_connection(lambda: protocol, "127.0.0.1"
+			, protocol._port)
+
+class CountingManager(LocalManager):
+	'''
+	LocalManager with a trivial on_message handler, so posts are dispatched.
+	`on_usercount` fires once per group, after its burst
+	'''
+	def on_message(self, group, post):
+		pass
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+#sharding.py
+'''
+Throughput of ShardedManager by number of worker processes, against the mock
+server. Every group is sent the same burst of posts, which the workers parse,
+pair and dispatch to an on_message handler. Reported is the time from joining
+until every group has received its whole burst, with an unsharded Manager for
+comparison. Throughput should grow with the number of workers, up to the
+number of cores left over by the mock server.
+'''
+import os
+import time
+import asyncio
+import argparse
+
+from ..sharding import ShardedManager
+from .mockserver import MockServer, CountingManager
+
+def run(workers, groups, port):
+	'''
+	Seconds for `groups` groups to receive their bursts from the mock server
+	on `port`, using `workers` worker processes, or an unsharded Manager if 0
+	'''
+	loop = asyncio.new_event_loop()
+	if workers:
+		manager = ShardedManager("", "", workers=workers, loop=loop
+			, manager_class=CountingManager)
+	else:
+		manager = CountingManager("", "", loop=loop)
+	done = loop.create_future()
+	finished = set()
+	#the user count frame ends each burst, after every post
+	def on_usercount(group):
+		finished.add(group.name)
+		if len(finished) == groups and not done.done():
+			done.set_result(None)
+	manager.add_event("on_usercount", on_usercount)
+
+	async def main():
+		if workers:
+			#wait for the workers to start, which isn't what's measured
+			await asyncio.gather(*(manager._request(worker, "leave_all")
+				for worker in range(workers)))
+		start = time.perf_counter()
+		await asyncio.gather(*(manager.join_group("bench{}".format(number)
+			, port) for number in range(groups)))
+		await done
+		return time.perf_counter() - start
+
+	try:
+		return loop.run_until_complete(main())
+	finally:
+		manager.stop()
+		loop.close()
+
+def main():
+	cores = os.cpu_count() or 1
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument("--groups", type=int, default=64
+		, help="groups joined (default: 64)")
+	parser.add_argument("--posts", type=int, default=5000
+		, help="posts sent to each group (default: 5000)")
+	parser.add_argument("--workers", type=int, nargs="+"
+		, default=sorted({1, 2, 4, 8, cores} & set(range(1, cores + 1)))
+		, help="worker counts to try (default: powers of 2 up to the cores)")
+	args = parser.parse_args()
+	total = args.groups * args.posts
+	print("{} groups x {} posts, {} cores".format(args.groups, args.posts
+		, cores))
+	with MockServer(args.posts) as server:
+		baseline = None
+		for workers in [0] + args.workers:
+			seconds = run(workers, args.groups, server.port)
+			if baseline is None:
+				baseline = seconds
+			print("{:>12}: {:7.2f} s {:10.0f} posts/s {:5.2f}x".format(
+				"{} workers".format(workers) if workers else "unsharded"
+				, seconds, total / seconds, baseline / seconds))
+
+if __name__ == "__main__":
+	main()
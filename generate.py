@@ -2,6 +2,9 @@
 #generate.py
 '''Generator functions for ids and server numbers'''
 import random
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import accumulate
 
 _WEIGHTS = [
 	  (5, 75), (6, 75), (7, 75), (8, 75), (16, 75), (17, 75)
@@ -20,6 +23,9 @@ _WEIGHTS = [
 	, (84, 116)
 ]
 _TOTAL_WEIGHT = sum([n[1] for n in _WEIGHTS])
+#server numbers and running totals of _WEIGHTS, for binary search
+_SERVERS = [n[0] for n in _WEIGHTS]
+_CUMULATIVE = list(accumulate(n[1] for n in _WEIGHTS))
 _SPECIALS = {
 	  "de-livechat": 5, "ver-anime": 8, "watch-dragonball": 8, "narutowire": 10
 	, "dbzepisodeorg": 10, "animelinkz": 20, "kiiiikiii": 21, "soccerjumbo": 21
@@ -54,6 +60,7 @@ def reverse_aid(goal, group_id) -> str:
 	return "".join(map(lambda g, v: str((int(g) - int(v)) % 10)
 		, goal, group_id[4:8]))
 
+@lru_cache(maxsize=4096)
 def server_num(group) -> int:
 	'''Return server number, or -1 if no server found'''
 	#this is black magic I got from ch.py
@@ -66,9 +73,13 @@ def server_num(group) -> int:
 	temp = max(int(group[6:9], 36), 1000) if len(group) >= 7 else 1000
 	max_weight = int(group[:5], 36) % temp
 
-	total = 0
-	for ret, weight in _WEIGHTS:
-		total += weight*temp / _TOTAL_WEIGHT
-		if total >= max_weight:
-			return ret
-	return -1
+	#first server where cumulative weight * temp / total >= max_weight,
+	#solved in integers so that no float accumulates
+	index = bisect_left(_CUMULATIVE, -(-max_weight * _TOTAL_WEIGHT // temp))
+	if index == len(_SERVERS):
+		return -1
+	return _SERVERS[index]
+
+def server_nums(groups) -> list:
+	'''Return a list of server numbers for each group name in `groups`'''
+	return list(map(server_num, groups))
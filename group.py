@@ -6,28 +6,44 @@ Objects representing Groups and Group connections in Chatango.
 Implements an asyncio-compatible protocol and provides classes for parsing raw
 group data like users, bans, and moderator actions.
 '''
+import sys
 import json
 import html
 import asyncio
+from bisect import bisect_left
+from collections import deque
+from types import MappingProxyType
 from urllib import parse
 
 from . import base, generate
 from .post import Post
+from .scheduler import SendScheduler, PRIORITY_MOD, PRIORITY_POST
+from .pairing import PairingBuffer, PAIRING_EMIT
+from .bans import BanStore
+from .wordfilter import BannedWords
 
 BIGMESSAGE_CUT = 0
 BIGMESSAGE_MULTIPLE = 1
 
+#what send_post does with posts containing banned words
+BANNED_PASS = 0		#send anyway; the server censors them
+BANNED_REJECT = 1	#raise ValueError
+BANNED_MASK = 2		#censor them before sending
+
 class User:
 	'''
 	User in a particular Group. Contains all clients (i.e. browser tabs) the
 	user belongs to and moderator flags.
 	'''
 	_AVATAR_URL = "http://fp.chatango.com/profileimg/{}/{}/{}/full.jpg"
+	__slots__ = ("_name", "_group", "_clients", "_sessions", "_mod_flags"
+		, "_join_time")
 	def __init__(self, group, name: str, unid=None, session_id=None, join_time=None, mod_flags=0):
-		self._name = name
+		self._name = sys.intern(name)
 		self._group = group
 		self._clients = {}
 		self._sessions = set()
+		self._join_time = 0		#earliest join time, or None to recompute
 		if unid is not None and join_time is not None:
 			self.new_client(unid, session_id, join_time)
 		self._mod_flags = ModFlags(mod_flags)
@@ -36,14 +52,19 @@ class User:
 		, doc="Display name")
 	group = property(lambda self: self._group
 		, doc="Group the User belongs to")
-	clients = property(lambda self: self._clients.copy()
-		, doc="Dict whose keys are client IDs and values are join times")
-	sessions = property(lambda self: self._sessions.copy()
-		, doc="Set of user sessions, which are consistent between browser "\
-			  "tabs/usernames, but not between browsers")
-	join_time = property(lambda self: min(self._clients.values()) \
-			if self._clients else 0
-		, doc="Float representing earliest join time")
+	clients = property(lambda self: MappingProxyType(self._clients)
+		, doc="Read-only dict whose keys are client IDs and values are join "\
+			  "times. Use `.copy()` for a snapshot")
+	sessions = property(lambda self: base.SetView(self._sessions)
+		, doc="Read-only set of user sessions, which are consistent between "\
+			  "browser tabs/usernames, but not between browsers")
+	@property
+	def join_time(self):
+		'''Float representing earliest join time'''
+		if self._join_time is None:
+			self._join_time = min(self._clients.values()) \
+				if self._clients else 0
+		return self._join_time
 	joined = property(lambda self: bool(self._clients)
 		, doc="Whether the user currently exists within the group")
 	mod_flags = property(lambda self: self._mod_flags
@@ -84,11 +105,11 @@ class User:
 
 	@classmethod
 	def init_mod(cls, group, args):
-		for user in group._users:
-			if user == args[0]:
-				user.promote(args[1])
-				return user
-		return cls(group, args[0], mod_flags=args[1])
+		user = group._members.get(args[0])
+		if user is not None:
+			user.promote(args[1])
+			return user
+		return group._members.add(cls(group, args[0], mod_flags=args[1]))
 
 	@classmethod
 	def init_participant(cls, group, args):
@@ -98,31 +119,22 @@ class User:
 		False:	User left
 		True:	User joined
 		'''
+		members = group._members
 		joined = int(args[0])
 		username = args[3]
-		#handle moderators changed
-		for mod in group.mods:
-			if mod == username:
-				if joined:
-					mod.new_client(args[1], args[2], args[6])
-				else:
-					mod.remove_client(args[1], args[2])
-				return mod, bool(joined)
-			#user logout occurred
-			if joined == 2 and int(args[1]) in mod.clients:
-				mod.remove_client(args[1])
-				return mod, False
 		#handle user changed
-		for user in group._users:
-			if user == username:
-				if joined:
-					user.new_client(args[1], args[2], args[6])
-				else:
-					user.remove_client(args[1], args[2])
-				return user, bool(joined)
-			#user logout occurred
-			if joined == 2 and int(args[1]) in user.clients:
-				user.remove_client(args[1], args[2])
+		user = members.get(username) if username != "None" else None
+		if user is not None:
+			if joined:
+				members.join(user, args[1], args[2], args[6])
+			else:
+				members.leave(user, args[1], args[2])
+			return user, bool(joined)
+		#user logout occurred
+		if joined == 2:
+			user = members.by_client(args[1])
+			if user is not None:
+				members.leave(user, args[1], args[2])
 				return user, False
 		#anon or user name setting occurred
 		if username == "None":
@@ -131,24 +143,23 @@ class User:
 			else:
 				username = "anon"
 			return username, True
-		return cls(group, username, unid=args[1], session_id=args[2], join_time=args[6]), True
+		if not joined:
+			return username, False
+		user = members.add(cls(group, username))
+		members.join(user, args[1], args[2], args[6])
+		return user, True
 
 	@classmethod
 	def init_g_participant(cls, group, args):
 		username = args[3]
 		if username == "None":
 			return None
-		#handle moderators changed
-		for mod in group.mods:
-			if mod == username:
-				mod.new_client(args[0], args[2], args[1])
-				return mod
-		#handle user changed
-		for user in group.users:
-			if user == username:
-				user.new_client(args[0], args[2], args[1])
-				return user
-		return cls(group, args[3], unid=args[0], session_id=args[2], join_time=args[1])
+		members = group._members
+		user = members.get(username)
+		if user is None:
+			user = members.add(cls(group, username))
+		members.join(user, args[0], args[2], args[1])
+		return user
 
 	def promote(self, flags):
 		'''Set the mod flags. Used internally when mods are promoted/demoted'''
@@ -159,25 +170,157 @@ class User:
 		unid = int(unid)
 		if unid in self._clients:
 			del self._clients[int(unid)]
+			self._join_time = None
 		self._sessions.discard(session_id)
 
 	def new_client(self, unid, session_id, join_time):
 		'''Add entry to clients. Used internally on user joined'''
 		self._clients[int(unid)] = float(join_time)
 		self._sessions.add(session_id)
+		self._join_time = None
+
+class Members:
+	'''
+	Every known User of a group, indexed by lowercase name, session ID and
+	client ID. Indices are kept up to date as clients join and leave, so
+	lookups don't depend on the number of users in the group.
+	'''
+	def __init__(self, group):
+		self._group = group
+		self._by_name = {}		#lowercase name -> User
+		self._by_session = {}	#session id -> {client id: User}
+		self._by_client = {}	#client id -> (User, session id)
+		self._present = set()	#Users with at least one client
+
+	def __len__(self):
+		return len(self._by_name)
+
+	def __iter__(self):
+		return iter(self._by_name.values())
+
+	def __contains__(self, user):
+		return str(user).lower() in self._by_name
+
+	def get(self, name):
+		'''User with (case-insensitive) name `name`, or None'''
+		return self._by_name.get(str(name).lower())
+
+	def by_session(self, session_id):
+		'''User of the newest client with session `session_id`, or None'''
+		clients = self._by_session.get(str(session_id))
+		return next(reversed(clients.values())) if clients else None
+
+	def by_client(self, unid):
+		'''User with client ID `unid`, or None'''
+		return self._by_client.get(int(unid), (None,))[0]
+
+	def _index(self, user, unid, session_id):
+		self._unindex(unid)
+		self._by_client[unid] = (user, session_id)
+		self._by_session.setdefault(str(session_id), {})[unid] = user
+
+	def _unindex(self, unid):
+		'''Forget client `unid`, and its session once no other client has it'''
+		known = self._by_client.pop(unid, None)
+		if known is None:
+			return
+		clients = self._by_session[str(known[1])]
+		del clients[unid]
+		if not clients:
+			del self._by_session[str(known[1])]
+
+	def add(self, user):
+		'''Index `user` and return it, or the User already known by its name'''
+		ret = self._by_name.setdefault(user.name.lower(), user)
+		if ret is user:
+			if user._clients:
+				self._present.add(user)
+			session_id = next(iter(user._sessions), None)
+			for unid in user._clients:
+				self._index(user, unid, session_id)
+		return ret
+
+	def discard(self, user):
+		'''Forget `user` and all of its clients'''
+		if self._by_name.get(user.name.lower()) is not user:
+			return
+		del self._by_name[user.name.lower()]
+		self._present.discard(user)
+		for unid in user._clients:
+			if self._by_client.get(unid, (None,))[0] is user:
+				self._unindex(unid)
+
+	def join(self, user, unid, session_id, join_time):
+		'''Add a client to `user`. Used internally on user joined'''
+		user.new_client(unid, session_id, join_time)
+		self._index(user, int(unid), session_id)
+		self._present.add(user)
+
+	def leave(self, user, unid, session_id):
+		'''
+		Remove a client from `user`. Users who are not moderators are forgotten
+		once their last client leaves. Used internally on user left
+		'''
+		user.remove_client(unid, session_id)
+		if self._by_client.get(int(unid), (None,))[0] is user:
+			self._unindex(int(unid))
+		if not user._clients:
+			self._present.discard(user)
+			if user not in self._group._mods:
+				self.discard(user)
+
+	def sync(self, entries):
+		'''
+		Make the clients present match `entries`, an iterable of gparticipants
+		fields. Clients already known are left alone. Returns a 2-tuple of
+		lists of Users who joined and Users who left
+		'''
+		seen = set()
+		joined = []
+		for fields in entries:
+			if len(fields) < 4 or fields[3] == "None":
+				continue
+			unid = int(fields[0])
+			seen.add(unid)
+			known = self._by_client.get(unid)
+			if known is not None:
+				if known[0] == fields[3]:
+					continue
+				#client id reused under another name
+				self.leave(known[0], unid, known[1])
+			user = self.get(fields[3])
+			if user is None:
+				user = self.add(User(self._group, fields[3]))
+			if not user._clients:
+				joined.append(user)
+			self.join(user, unid, fields[2], fields[1])
+		left = []
+		for unid in [unid for unid in self._by_client if unid not in seen]:
+			user, session_id = self._by_client.get(unid, (None, None))
+			if user is None:
+				continue
+			self.leave(user, unid, session_id)
+			if not user._clients:
+				left.append(user)
+		return joined, left
 
 class Ban:
-	def __init__(self, user: str, ip: str, unid: str, mod: User, time: float):
-		self._user = user
+	__slots__ = ("_user", "_ip", "_unid", "_mod", "_time", "_group")
+	def __init__(self, user: str, ip: str, unid: str, mod: User, time: float
+	, group=None):
+		self._user = sys.intern(user)
 		self._ip = ip
 		self._unid = unid
 		self._mod = mod
 		self._time = time
+		self._group = group
 
 	user = property(lambda self: self._user
 		, doc="User that was banned")
-	group = property(lambda self: self._user.group
-		, doc="Group the Ban belongs to. Sugar for user.group")
+	group = property(lambda self: self._group
+		, doc="Group the Ban belongs to")
+	time = property(lambda self: self._time
+		, doc="Time the ban was made")
 	ip = property(lambda self: self._ip
 		, doc="IP Address the user was posting from")
 	unid = property(lambda self: self._unid
@@ -191,16 +334,30 @@ class Ban:
 
 class GroupProtocol(base.ChatangoProtocol):
 	'''Protocol for Chatango group commands'''
-	def __init__(self, room, manager, loop=None):
-		super().__init__(manager, Group(self, room), loop=loop)
+	_PAIRING_SIZE = 256				#unmatched posts (or unids) kept at once
+	_PAIRING_AGE = 30				#seconds a post waits for its unid
+	_PAIRING_EXPIRED = PAIRING_EMIT	#what to do with posts that never got one
+	def __init__(self, room, manager, loop=None, port=443, storage=None):
+		super().__init__(manager, Group(self, room) if storage is None \
+			else storage, loop=loop)
+		#reconnecting reuses the Group of the lost connection
+		self._storage._protocol = self
+		self._port = port
 		#intermediate message stuff and aux data for commands
-		self._messages = {}			#temp message dict for u command lookups
-		self._updates = {}			#same as above, but inverted; in case messages get mismatched
+		self._pairing = PairingBuffer(self._loop, self._deliver
+			, self._PAIRING_SIZE, self._PAIRING_AGE, self._PAIRING_EXPIRED)
 		self._history = []			#internal buffer for accumulating historical messages
+		self._history_listeners = set()	#queues of running Group.history iterators
 		self._last_message = 0		#unix epoch of last time message received
+		self._oldest = None			#time of the oldest post received, after which none are missing
 		self._history_count = 0		#number of times history has been retrieved
 		self._no_more = False		#no more historical messages from the server
-		self._last_modlog = 0		#last mod log update; dubiously work
+		self._modlog_listeners = set()	#queues of running Group.modlog_pages iterators
+		self._participants_loaded = False	#whether gparticipants has been received
+		#catching up after a reconnect
+		self._resume_from = None	#time of the last message before the connection dropped
+		self._resume_reached = False
+		self._missed = None			#posts after _resume_from by unid (or a counter), until caught up
 
 	def connection_made(self, transport):
 		'''Begins communication with the server and connects to the room'''
@@ -208,8 +365,99 @@ class GroupProtocol(base.ChatangoProtocol):
 		self.send_command("bauth", self._storage._name, self._session_id
 			, self._manager.username, self._manager.password, firstcmd=True)
 
+	def connection_lost(self, exc):
+		'''Drop commands still waiting on the rate limit, then maybe reconnect'''
+		self._storage._scheduler.clear()
+		self._pairing.clear()
+		if self._storage._banlist_handle is not None:
+			self._storage._banlist_handle.cancel()
+			self._storage._banlist_handle = None
+		#end running history and moderation log iterators
+		for listener in self._history_listeners:
+			listener.put_nowait(False)
+		for listener in self._modlog_listeners:
+			listener.put_nowait([])
+		reconnect = self.connected and self._manager.reconnect is not None
+		super().connection_lost(exc)
+		if reconnect:
+			self._storage._ready.clear()
+			self._loop.create_task(self._manager._reconnect(self))
+
+	def _resume(self, old):
+		'''
+		Continue from lost GroupProtocol `old`, delivering only posts newer than
+		its last message. Used internally when reconnecting
+		'''
+		self._last_message = old._last_message
+		if old._missed is not None:
+			#dropped again while catching up; posts held are still undelivered
+			self._resume_from = old._resume_from
+			self._missed = old._missed
+			return
+		archive = self._manager.archive
+		if archive is not None:
+			#nothing older than the newest archived post needs fetching
+			self._last_message = max(self._last_message
+				, archive.latest(self._storage))
+		if self._last_message:
+			self._resume_from = self._last_message
+			self._missed = {}
+
+	def _deliver(self, post):
+		'''Fire on_message, or hold the post while catching up after a reconnect'''
+		if self._missed is not None:
+			#expired posts without a unid can't turn up in history; keep each
+			key = post.unid if post.unid is not None else (None, len(self._missed))
+			self._missed[key] = post
+		else:
+			self._fire_message(post)
+
+	def _fire_message(self, post):
+		'''Archive a live post, fire on_message and check for ban evasion'''
+		self._archive(post)
+		self._call_event("on_message", post)
+		self._check_evasion(post)
+
+	def _check_evasion(self, post):
+		'''
+		Fire on_ban_evasion_suspect if the IP of `post`, live or historical,
+		shares a prefix with a banned one
+		'''
+		#only mods see IPs, and matching costs nothing if no one listens
+		if post.ip and self._storage._bans \
+		and self._manager._get_handlers("on_ban_evasion_suspect"):
+			match = self._storage._bans.match_ip(post.ip)
+			if match is not None:
+				self._call_event("on_ban_evasion_suspect", post, *match)
+
+	def _archive(self, post):
+		'''Add a live post to the manager's archive, if it has one'''
+		archive = self._manager.archive
+		if archive is None:
+			return
+		archive.add(self._storage, post)
+		if self._oldest is None:
+			self._oldest = post.time
+		#everything since the oldest post of this connection has been seen
+		archive.cover(self._storage, self._oldest, post.time)
+
+	def _catch_up(self):
+		'''Request history until it reaches back to the last connection'''
+		if not self._resume_reached and not self._no_more:
+			self._storage.get_more()
+			return
+		missed = sorted(self._missed.values(), key=lambda post: post.time)
+		#the history fetched joins up with the lost connection's
+		self._oldest = self._resume_from
+		self._resume_from = self._missed = None
+		self._storage._reconnect_attempts = 0
+		self._storage._ready.set()
+		self._call_event("on_reconnect")
+		for post in missed:
+			self._fire_message(post)
+
 	#COMMAND PARSING-----------------------------------------------------------
-	async def _recv_ok(self, args):
+	def _recv_ok(self, args):
 		'''ACK that login succeeded'''
 		if args[2] == 'C':
 			if self._manager.username: #set temporary name
@@ -221,6 +469,7 @@ class GroupProtocol(base.ChatangoProtocol):
 				else:
 					ncolor = generate.anon_ncolor()
 				self._storage._n_color = ncolor
+				self._storage._header = None
 				self._storage._aid = generate.aid(ncolor, args[1])
 		else:
 			self._storage._aid = None
@@ -236,175 +485,230 @@ class GroupProtocol(base.ChatangoProtocol):
 		self._call_event("on_denied")
 		await self.disconnect()
 
-	async def _recv_badalias(self, _):
+	def _recv_badalias(self, _):
 		'''NACK to blogin. Has corresponding ACK, but does nothing'''
 		self._call_event("on_bad_alias")
 
-	async def _recv_inited(self, _):
+	def _recv_inited(self, _):
 		'''Room inited, after recent messages have sent'''
 		self.send_command("gparticipants")		#open up feed for members joining/leaving
 		self.send_command("getpremium", '1')	#try to turn on premium features
 		self.send_command("getbannedwords")		#what it says on the tin
 		self.send_command("getratelimit")		#get posts allowed per n seconds
+		if self._missed is not None:
+			self._catch_up()
+			return
+		self._storage._reconnect_attempts = 0
 		self._storage._ready.set()
 		self._call_event("on_connect")
-		self._call_event("on_history_done", self._history.copy()) #clone history
-		self._history.clear()
+		self._history_done()
 
-	async def _recv_gparticipants(self, args):
-		'''Command that contains information of current room members'''
-		self._storage._users.clear()
-		#gparticipants splits people by ;
-		people = ':'.join(args[1:]).split(';')
+	@staticmethod
+	def _split_participants(args):
+		'''
+		Generator of the fields of each person in gparticipants `args`.
+		People are split by ';', which falls inside an arg
+		'''
+		fields = []
+		for arg in args:
+			if ';' not in arg:
+				fields.append(arg)
+				continue
+			pieces = arg.split(';')
+			fields.append(pieces[0])
+			for piece in pieces[1:]:
+				yield fields
+				fields = [piece]
 		#room is empty except anons
-		if people[0]:
-			for person in people:
-				self._storage._users.add(
-					User.init_g_participant(self._storage, person.split(':')))
+		if fields != [""]:
+			yield fields
+
+	def _recv_gparticipants(self, args):
+		'''Command that contains information of current room members'''
+		joined, left = self._storage._members.sync(
+			self._split_participants(args[1:]))
+		#on a reload, only report what changed since the last list
+		if self._participants_loaded:
+			for user in left:
+				self._call_event("on_member_leave", user)
+			for user in joined:
+				self._call_event("on_member_join", user)
+		self._participants_loaded = True
 		self._call_event("on_participants")
 
-	async def _recv_participant(self, args):
+	def _recv_participant(self, args):
 		'''New member joined or left'''
 		participant, joined = User.init_participant(self._storage, args)
 		if joined:
-			if isinstance(participant, User):
-				self._storage._users.add(participant)
 			self._call_event("on_member_join", participant)
 		else:
 			self._call_event("on_member_leave", participant)
 
-	async def _recv_n(self, args):
+	def _recv_n(self, args):
 		'''Number of users, in base 16'''
 		self._storage._usercount = int(args[0], 16)
 		self._call_event("on_usercount")
 
-	async def _recv_bw(self, args):
+	def _recv_bw(self, args):
 		'''Banned words'''
 		parts = parse.unquote(args[0])
 		words = parse.unquote(args[1])
 		self._storage._banned_parts = parts.split(',')
 		self._storage._banned_words = words.split(',')
+		self._storage._banned_matcher.update(self._storage._banned_parts
+			, self._storage._banned_words)
 
-	async def _recv_b(self, args):
+	def _recv_b(self, args):
 		'''Message received'''
 		post = Post.normal(self._storage, args)
 		if post.time > self._last_message:
 			self._last_message = post.time
-		if post.pnum in self._updates:
-			post.unid = self._updates[post.pnum]
-			self._call_event("on_message", post)
-			del self._updates[post.pnum]
-		else: #wait for push by update message
-			self._messages[post.pnum] = post
-
-	async def _recv_u(self, args):
+		#delivered once the update message gives it a unid
+		self._pairing.add_post(post)
+
+	def _recv_u(self, args):
 		'''Message updated'''
-		post = self._messages.get(args[0])
-		if post is not None:
-			del self._messages[args[0]]
-			post.unid = args[1]
-			self._call_event("on_message", post)
-		else:
-			self._updates[args[0]] = args[1]
+		self._pairing.add_unid(args[0], args[1])
 
-	async def _recv_i(self, args):
+	def _recv_i(self, args):
 		'''Historical message'''
 		post = Post.history(self._storage, args)
 		if post.time > self._last_message:
 			self._last_message = post.time
-		self._history.append(post)
-
-	async def _recv_annc(self, args):
+		if self._missed is not None:
+			if post.time > self._resume_from:
+				self._missed.setdefault(post.unid, post)
+			else:
+				self._resume_reached = True
+			return
+		if self._oldest is None or post.time < self._oldest:
+			self._oldest = post.time
+		if self._manager.archive is not None:
+			self._manager.archive.add(self._storage, post)
+		for listener in self._history_listeners:
+			listener.put_nowait(post)
+		#only keep a batch around if someone wants it
+		if self._manager._get_handlers("on_history_done"):
+			self._history.append(post)
+		self._check_evasion(post)
+
+	def _recv_annc(self, args):
 		'''Automatic message'''
 		post = Post.announcement(self._storage, args)
 		self._call_event("on_announce", post)
 
-	async def _recv_getannc(self, args):
+	def _recv_getannc(self, args):
 		'''Retrieve announcement'''
 		post = Post.announcement(self._storage, args, mod=True)
 		self._call_event("on_got_announcement", post)
 
-	async def _recv_gotmore(self, _):
+	def _recv_gotmore(self, _):
 		'''Received all historical messages'''
-		self._call_event("on_history_done", self._history.copy())
-		self._history.clear()
 		self._history_count += 1
+		if self._missed is not None:
+			self._catch_up()
+			return
+		self._history_done()
+		for listener in self._history_listeners:
+			listener.put_nowait(None)
 
-	async def _recv_nomore(self, _):
+	def _recv_nomore(self, _):
 		self._no_more = True
+		if self._missed is not None:
+			self._catch_up()
+			return
+		for listener in self._history_listeners:
+			listener.put_nowait(False)
 		self._call_event("on_no_more")
 
-	async def _recv_ratelimitset(self, args):
+	def _history_done(self):
+		'''Fire on_history_done with the posts received since the last time'''
+		history, self._history = self._history, []
+		archive = self._manager.archive
+		if archive is not None and self._oldest is not None:
+			archive.cover(self._storage, self._oldest, self._last_message)
+		self._call_event("on_history_done", history)
+
+	async def _listen(self, listener):
+		'''
+		(Coro) Next item put on the iterator queue `listener`. Reading isn't
+		paused meanwhile, since the iterator may run inside a queued handler
+		'''
+		self._events.hold()
+		try:
+			return await listener.get()
+		finally:
+			self._events.release()
+
+	def _recv_ratelimitset(self, args):
 		self._storage._ratelimit = int(args[1])
+		self._storage._scheduler.set_ratelimit(self._storage._ratelimit)
 		self._call_event("on_ratelimit", self._storage.ratelimit)
 
-	async def _recv_show_fw(self, _):
+	def _recv_show_fw(self, _):
 		'''Flood warning'''
+		self._storage._scheduler.flood_warning()
 		self._call_event("on_flood_warning")
 
-	async def _recv_show_tb(self, args):
+	def _recv_show_tb(self, args):
 		'''Flood ban'''
+		self._storage._scheduler.flood_ban(int(args[0]))
 		self._call_event("on_flood_ban", int(args[0]))
 
-	async def _recv_tb(self, args):
+	def _recv_tb(self, args):
 		'''Flood ban reminder'''
+		self._storage._scheduler.flood_ban(int(args[0]))
 		self._call_event("on_flood_ban_repeat", int(args[0]))
 
-	async def _recv_groupflagsupdate(self, args):
+	def _recv_groupflagsupdate(self, args):
 		'''Flags updated'''
 		self._storage._settings = GroupFlags(int(args[0]))
 		self._call_event("on_settings_update")
 
-	async def _recv_updgroupinfo(self, args):
+	def _recv_updgroupinfo(self, args):
 		'''Group info (title and MOTD) updated'''
 		self._call_event("on_groupinfo_update", args[0], args[1])
 
-	async def _recv_modactions(self, args):
-		ret = [ModLog(self._storage, action)
-			for action in ':'.join(args).split(';')]
-		#TODO not sure this is actually how it works
-		self._last_modlog = ret[-1].unid
-		self._storage._modlog.extend(ret)
-		self._call_event("on_modlog_update", ret)
-
-	async def _recv_blocklist(self, args):
+	def _recv_modactions(self, args):
+		'''Page of moderator log entries'''
+		page = [ModLog(self._storage, action)
+			for action in ':'.join(args).split(';') if action]
+		for listener in self._modlog_listeners:
+			listener.put_nowait(page)
+		ret = self._storage._modlog._add(page)
+		if ret:
+			self._call_event("on_modlog_update", ret)
+
+	def _recv_blocklist(self, args):
 		'''Received list of banned users'''
-		self._storage._banlist.clear()
+		bans = []
 		sections = ':'.join(args).split(';')
 		for section in sections:
 			params = section.split(':')
 			if len(params) != 5: #sanity check
 				continue
 			#find the moderator responsible in the list of mods
-			source = params[4].lower()
-			for mod in self._storage.mods:
-				if str(mod).lower() == source:
-					source = mod
-					break
-			ban = Ban(params[2], params[1], params[0], source, float(params[3]))
-			self._storage._banlist.append(ban)
+			source = self._storage._find_mod(params[4]) or params[4].lower()
+			bans.append(Ban(params[2], params[1], params[0], source
+				, float(params[3]), self._storage))
+		self._storage._bans._replace(bans)
 		self._call_event("on_banlist_update")
 
-	async def _recv_blocked(self, args):
+	def _recv_blocked(self, args):
 		'''User banned'''
-		source = args[3].lower()
-		for mod in self._storage.mods:
-			if str(mod).lower() == source:
-				source = mod
-				break
-		ban = Ban(args[2], args[1], args[0], source, float(args[4]))
+		source = self._storage._find_mod(args[3]) or args[3].lower()
+		ban = Ban(args[2], args[1], args[0], source, float(args[4])
+			, self._storage)
+		self._storage._bans._add(ban)
 		self._call_event("on_ban", ban)
-		self._storage.request_banlist()
 
-	async def _recv_unblocked(self, args):
+	def _recv_unblocked(self, args):
 		'''User unbanned'''
-		for ban in self._storage._bans:
-			if args[0] == ban.unid:
-				self._call_event("on_unban", ban)
-				break
-		self._storage.request_banlist()
+		ban = self._storage._bans._remove(args[0])
+		if ban is not None:
+			self._call_event("on_unban", ban)
 
-	async def _recv_mods(self, args):
+	def _recv_mods(self, args):
 		'''Moderators changed'''
 		new = set(User.init_mod(self._storage, mod.split(','))
 			for mod in args)
@@ -414,14 +718,16 @@ class GroupProtocol(base.ChatangoProtocol):
 			self._call_event("on_mod_add", mod)
 		for mod in old - new: #demodded
 			self._storage._mods.remove(mod)
+			if not mod.joined:
+				self._storage._members.discard(mod)
 			self._call_event("on_mod_remove", mod)
 		self._call_event("on_mod_change")
 
-	async def _recv_delete(self, args):
+	def _recv_delete(self, args):
 		'''Message deleted'''
 		self._call_event("on_message_delete", args[0])
 
-	async def _recv_deleteall(self, args):
+	def _recv_deleteall(self, args):
 		'''Message delete (multiple)'''
 		for msgid in args:
 			self._call_event("on_message_delete", msgid)
@@ -431,12 +737,15 @@ class Group(base.Connection):
 	'''Class for high-level group communication and storing group information'''
 	_MAX_LENGTH = 2000
 	_TOO_BIG_MESSAGE = BIGMESSAGE_MULTIPLE
+	_BANNED_WORD_POLICY = BANNED_PASS
+	_MODLOG_SIZE = 1000			#moderator log entries kept
+	_BANLIST_INTERVAL = 10		#minimum seconds between full ban list requests
 	def __init__(self, protocol, room):
 		super().__init__(protocol)
 		#user information
 		self._name = room				#group name
 		self._owner = None				#owner of the server
-		self._users = set()
+		self._members = Members(self)	#all Users, indexed by name, session, client
 		self._usercount = 0
 		self._ready = asyncio.Event()
 		#mod data
@@ -444,9 +753,14 @@ class Group(base.Connection):
 		self._mods = set()				#set of Users with mod_flags set
 		self._banned_parts = []			#parts of words that are banned
 		self._banned_words = []			#entire words that are banned
-		self._bans = []					#list of Bans
+		self._banned_matcher = BannedWords()
+		self._bans = BanStore()			#Bans, indexed by unid, username and IP
+		self._banlist_sent = None		#loop time of the last blocklist request
+		self._banlist_handle = None		#delayed blocklist request
+		self._reconnect_attempts = 0	#since the last connection that caught up
 		self._ratelimit = 0
-		self._modlog = []
+		self._scheduler = SendScheduler(self)
+		self._modlog = ModLogBuffer(self._MODLOG_SIZE)
 
 	#########################################
 	#	Properties
@@ -468,8 +782,8 @@ class Group(base.Connection):
 		, doc="Name of the group")
 	owner = property(lambda self: self._owner
 		, doc="Name of the owner of the group")
-	users = property(lambda self: [user for user in self._users if user.clients]
-		, doc="List of Users in the group")
+	users = property(lambda self: base.SetView(self._members._present)
+		, doc="Read-only set of Users in the group. Use `.copy()` for a snapshot")
 	usercount = property(lambda self: self._usercount
 		, doc="User count")
 	last_message = property(lambda self: self._protocol._last_message
@@ -481,41 +795,56 @@ class Group(base.Connection):
 	#mod attributes
 	settings = property(lambda self: self._settings
 		, doc="GroupFlags currently active in the group or None, if not mod")
-	mods = property(lambda self: self._mods.copy()
-		, doc="List of Users. Moderator only.")
-	bans = property(lambda self: self._bans.copy()
-		, doc="List of Bans. Moderator only.")
+	mods = property(lambda self: base.SetView(self._mods)
+		, doc="Read-only set of Users. Moderator only.")
+	bans = property(lambda self: self._bans
+		, doc="Read-only BanStore of Bans. Moderator only.")
 	banned_words = property(lambda self: (self._banned_words.copy()
 		, self._banned_parts.copy())
 		, doc="A 2-tuple of lists of partially banned words and "\
 			"totally banned words")
-	ratelimit = property(lambda self: self._modlog
+	ratelimit = property(lambda self: self._ratelimit
 		, doc="Rate limit. One message allowed per this many seconds")
-	modlog = property(lambda self: self._modlog.copy()
-		, doc="A list of ModLog objects: the most recent moderator actions")
+	scheduler = property(lambda self: self._scheduler
+		, doc="SendScheduler pacing posts. Reports queue depth and wait times")
+	pairing = property(lambda self: self._protocol._pairing
+		, doc="PairingBuffer matching posts with their unids. Reports pending,"\
+			" matched and expired counts and latency")
+	modlog = property(lambda self: self._modlog
+		, doc="A read-only ModLogBuffer of the most recent moderator actions, "\
+			"oldest first")
 
 	def send_post(self, post: str, channel=0, replace_html=True, badge=0):
 		'''Send a post to the group'''
 		#TODO allow badge sending
 		if not post:
 			return
+		if self._BANNED_WORD_POLICY != BANNED_PASS:
+			if self._BANNED_WORD_POLICY == BANNED_MASK:
+				post = self._banned_matcher.mask(post)
+			elif self._banned_matcher.find(post):
+				raise ValueError("post contains banned words")
 		channel = (((channel&2)<<2 | (channel&1))<<8)
 		if replace_html:
 			#replace HTML equivalents
 			post = html.escape(post)
 			post = post.replace('\n', "<br/>")
+		#chunks are already checked and escaped
 		if len(post) > self._MAX_LENGTH:
 			if self._TOO_BIG_MESSAGE == BIGMESSAGE_CUT:
-				self.send_post(post[:self._MAX_LENGTH], channel=channel, replace_html=False)
+				self._send_chunk(post[:self._MAX_LENGTH], channel)
 			elif self._TOO_BIG_MESSAGE == BIGMESSAGE_MULTIPLE:
 				while post:
 					sect = post[:self._MAX_LENGTH]
 					post = post[self._MAX_LENGTH:]
-					self.send_post(sect, channel, replace_html=False)
+					self._send_chunk(sect, channel)
 			return
-		self._protocol.send_command("bm", "meme", str(channel)
-			, ("<n{0._n_color}/><f x{0._f_size:02d}{0._f_color}="\
-			  "\"{0._f_face}\">{1}").format(self, post))
+		self._send_chunk(post, channel)
+
+	def _send_chunk(self, post, channel):
+		'''Queue a formatted post no longer than `_MAX_LENGTH`'''
+		self._scheduler.submit(PRIORITY_POST, "bm", "meme", str(channel)
+			, self._post_header() + post)
 
 	def get_more(self, amt=20):
 		'''Get more historical messages'''
@@ -523,19 +852,73 @@ class Group(base.Connection):
 			self._protocol.send_command("get_more", str(amt)
 				, str(self._protocol._history_count))
 
+	async def history(self, until=0, batch=20):
+		'''
+		Async iterator of historical posts, yielded as they arrive. Batches of
+		`batch` posts are requested with `get_more` as the iterator is consumed.
+		Stops after the batch containing posts older than `until`, when the
+		server has no more, or when the connection is lost.
+		If the manager has an archive, posts it holds are yielded first, newest
+		first, and only older posts are taken from the server
+		'''
+		protocol = self._protocol
+		archive = protocol._manager.archive
+		served = float("inf")	#posts at or after this came from the archive
+		if archive is not None and protocol._oldest is not None:
+			start = archive.covered_from(self, protocol._oldest)
+			if start is not None:
+				for post in archive.range(self, max(start, until)
+				, protocol._oldest, newest_first=True):
+					if post.time < protocol._oldest:
+						yield post
+				if start <= until:
+					return
+				served = start
+		listener = asyncio.Queue()
+		protocol._history_listeners.add(listener)
+		try:
+			while not protocol._no_more:
+				self.get_more(batch)
+				reached = False
+				post = await protocol._listen(listener)
+				while post:
+					if post.time < until:
+						reached = True
+					elif post.time < served:
+						yield post
+					post = await protocol._listen(listener)
+				#False: no more history or connection lost
+				if reached or post is False:
+					break
+		finally:
+			protocol._history_listeners.discard(listener)
+
+	def check_banned(self, text):
+		'''
+		List of 3-tuples of start index, end index and banned word for each
+		banned word in `text`. Empty if `text` would not be censored
+		'''
+		return self._banned_matcher.find(text)
+
 	def has_permission(self, flags):
 		'''Get whether the current user has permissions for a mod action'''
 		if self.username == self._owner:
 			return True
-		for mod in self._mods:
-			if mod.name == self.username:
-				return bool(mod.mod_flags & flags)
+		mod = self._members.get(self.username)
+		if mod is not None and mod in self._mods:
+			return bool(int(mod.mod_flags) & flags)
 		return False
 
+	def _find_mod(self, name):
+		'''The moderator (a User) named `name`, or None'''
+		mod = self._members.get(name)
+		return mod if mod in self._mods else None
+
 	def set_anon(self, id_number: int):
 		'''Set anon ID to 4 digit number `id_number`'''
 		if self.owner is not None: #received an ok
 			self._n_color = generate.reverse_aid(str(id_number), self._aid)
+			self._header = None
 		else:
 			self._aid = str(int(id_number) % 10000).zfill(4)
 
@@ -582,6 +965,7 @@ class Group(base.Connection):
 				self._banned_words.extend(
 					filter(lambda x: ',' not in x, total))
 
+			self._banned_matcher.update(self._banned_parts, self._banned_words)
 			self._protocol.send_command("setbannedwords"
 				, parse.quote(','.join(self._banned_parts))
 				, parse.quote(','.join(self._banned_words)))
@@ -604,12 +988,13 @@ class Group(base.Connection):
 			if isinstance(total, str):
 				total = [total]
 			if isinstance(total, list):
-				for total_ban in partial:
+				for total_ban in total:
 					try:
-						self._banned_totals.remove(total_ban)
+						self._banned_words.remove(total_ban)
 					except ValueError:
 						pass
 
+			self._banned_matcher.update(self._banned_parts, self._banned_words)
 			self._protocol.send_command("setbannedwords"
 				, parse.quote(','.join(self._banned_parts))
 				, parse.quote(','.join(self._banned_words)))
@@ -637,51 +1022,100 @@ class Group(base.Connection):
 			GroupFlags.update(self._protocol, (disable, 8192))
 
 	def request_banlist(self):
-		'''Request updated banlist'''
-		if self.has_permission(192):
-			self._protocol.send_command("blocklist", "block", "", "next", "500")
+		'''
+		Request updated banlist. Requests within `_BANLIST_INTERVAL` seconds of
+		the last are combined into one sent at the end of the interval
+		'''
+		if not self.has_permission(192) or self._banlist_handle is not None:
+			return
+		loop = self._protocol._loop
+		wait = 0 if self._banlist_sent is None else \
+			self._banlist_sent + self._BANLIST_INTERVAL - loop.time()
+		if wait > 0:
+			self._banlist_handle = loop.call_later(wait, self._send_banlist)
+		else:
+			self._send_banlist()
+
+	def _send_banlist(self):
+		self._banlist_handle = None
+		self._banlist_sent = self._protocol._loop.time()
+		self._protocol.send_command("blocklist", "block", "", "next", "500")
 
 	def delete(self, message: Post):
 		'''Delete a message'''
 		if self.has_permission(192):
-			self._protocol.send_command("delmsg", message.unid)
+			self._scheduler.submit(PRIORITY_MOD, "delmsg", message.unid)
 
 	def clear_user(self, message: Post):
 		'''Delete all of a user's messages.'''
 		if self.has_permission(192):
-			self._protocol.send_command("delallmsg", message.mod_id, message.ip, "")
+			self._scheduler.submit(PRIORITY_MOD, "delallmsg", message.mod_id
+				, message.ip, "")
 
 	def ban(self, message: Post):
 		'''Ban a user from a message.'''
 		if self.has_permission(192):
-			self._protocol.send_command("block", message.user, message.ip
-				, message.unid)
+			self._scheduler.submit(PRIORITY_MOD, "block", message.user
+				, message.ip, message.unid)
 
 	def unban(self, ban):
-		'''Repeal a ban. Ban must be a username or in `_bans`'''
+		'''Repeal a ban. Ban must be a username or in `bans`'''
 		if not self.has_permission(192):
 			return False
 		if isinstance(ban, (str, User)):
-			for record in self._bans:
-				if str(record.user) == str(ban):
-					ban = record
-					break
+			ban = self._bans.by_name(ban)
+			if ban is None:
+				return False
 		elif not isinstance(ban, Ban):
 			raise TypeError("can only unban Ban objects and usernames")
 		elif ban not in self._bans:
 			return False
-		self._protocol.send_command("removeblock", ban.unid, ban.ip
+		self._scheduler.submit(PRIORITY_MOD, "removeblock", ban.unid, ban.ip
 			, str(ban.user))
 		return True
 
 	def get_moderation_log(self, entry_count=50):
 		'''
-		Retrieve `entry_count` more entries from the moderation log.
-		Does nothing until `on_moderation_log` is fired.
+		Retrieve `entry_count` entries from the moderation log older than
+		those already retrieved. New entries are passed to `on_modlog_update`.
 		'''
 		if self.has_permission(256):
 			self._protocol.send_command("getmodactions", "prev"
-				, self._protocol._last_modlog, entry_count)
+				, str(self._modlog.cursor or 0), str(entry_count))
+
+	async def modlog_pages(self, batch=50):
+		'''
+		Async iterator of moderator log entries, newest first. Entries already
+		retrieved are yielded first, then older pages of `batch` entries are
+		requested as the iterator is consumed, until the log runs out
+		'''
+		if not self.has_permission(256):
+			return
+		cursor = None		#smallest entry id yielded so far
+		for entry in reversed(self._modlog.copy()):
+			cursor = int(entry.unid)
+			yield entry
+		protocol = self._protocol
+		listener = asyncio.Queue()
+		protocol._modlog_listeners.add(listener)
+		try:
+			while True:
+				protocol.send_command("getmodactions", "prev"
+					, str(cursor or 0), str(batch))
+				older = []
+				#skip pushed updates, which only hold newer entries
+				while not older:
+					page = await protocol._listen(listener)
+					if not page:
+						return
+					older = [entry for entry in page
+						if cursor is None or int(entry.unid) < cursor]
+				older.sort(key=lambda entry: int(entry.unid), reverse=True)
+				for entry in older:
+					cursor = int(entry.unid)
+					yield entry
+		finally:
+			protocol._modlog_listeners.discard(listener)
 
 	def auto_moderation(self, basic=False, repetitious=False, advanced=False):
 		'''
@@ -755,17 +1189,17 @@ class ModLog:
 		, "acls": "Room closed because no moderators"
 		, "aopn": "Room opened upon moderator login"
 	}
+	__slots__ = ("_group", "_unid", "_mnemonic", "_mod", "_ip", "_target"
+		, "_time", "_args")
 	def __init__(self, group: Group, args):
-		args = args.split(',')
+		#the arguments at the end are JSON, which can contain commas
+		args = args.split(',', 7)
 		self._group = group
 		self._unid = args[0]
-		self._mnemonic = args[1]
+		self._mnemonic = sys.intern(args[1])
 		moderator = args[2] if args[2] != "None" else None
 		if moderator is not None:
-			for mod in group._mods:
-				if mod == moderator:
-					moderator = mod
-					break
+			moderator = group._find_mod(moderator) or moderator
 		self._mod = moderator
 		self._ip = args[3] if args[3] != "None" else None
 		self._target = args[4] if args[3] != "None" else None
@@ -824,8 +1258,82 @@ class ModLog:
 			ret = ret.format("enabled" if self._args else "disabled")
 		return ret
 
+class ModLogBuffer(base.SequenceView):
+	'''
+	Read-only sequence of the newest `capacity` ModLogs of a group, oldest
+	first. Entries are indexed by id, so overlapping pages aren't duplicated
+	'''
+	__slots__ = ("_capacity", "_by_id", "_cursor")
+	def __init__(self, capacity):
+		super().__init__(deque())	#entry ids, ascending
+		self._capacity = capacity
+		self._by_id = {}
+		self._cursor = None		#smallest id ever added, held or not
+
+	capacity = property(lambda self: self._capacity
+		, doc="Number of entries kept")
+	oldest = property(lambda self: self._items[0] if self._items else None
+		, doc="Smallest entry id held, or None if empty")
+	cursor = property(lambda self: self._cursor
+		, doc="Smallest entry id retrieved, including those dropped for "\
+			  "capacity, or None. Older pages are requested from here")
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self._by_id[unid] for unid in list(self._items)[index]]
+		return self._by_id[self._items[index]]
+
+	def __iter__(self):
+		return (self._by_id[unid] for unid in self._items)
+
+	def __contains__(self, entry):
+		return int(getattr(entry, "unid", entry)) in self._by_id
+
+	def get(self, unid):
+		'''Entry with id `unid`, or None'''
+		return self._by_id.get(int(unid))
+
+	def copy(self):
+		'''Snapshot list of entries'''
+		return list(self)
+
+	def _add(self, entries):
+		'''
+		Add ModLogs not already held, dropping the oldest beyond capacity.
+		Returns a list of those added and still held. Used internally on
+		modactions
+		'''
+		items, by_id = self._items, self._by_id
+		newer, older, ret = [], [], []
+		for entry in entries:
+			unid = int(entry.unid)
+			if self._cursor is None or unid < self._cursor:
+				self._cursor = unid
+			if unid in by_id:
+				continue
+			if not items or unid > items[-1]:
+				newer.append(unid)
+			elif unid < items[0]:
+				#an older page; it would be dropped at once if already full
+				if len(items) >= self._capacity:
+					continue
+				older.append(unid)
+			else:
+				#fills a gap between entries held
+				items.insert(bisect_left(items, unid), unid)
+			by_id[unid] = entry
+			ret.append(entry)
+		newer.sort()
+		items.extend(newer)
+		older.sort(reverse=True)
+		items.extendleft(older)
+		while len(items) > self._capacity:
+			del by_id[items.popleft()]
+		return [entry for entry in ret if int(entry.unid) in by_id]
+
 class GroupFlags(base.Flags):
 	'''Group attributes that mods can change'''
+	__slots__ = ()
 	_EXPLAIN = [
 		  None							#1
 		, None							#2
@@ -892,6 +1400,7 @@ class GroupFlags(base.Flags):
 		protocol.send_command("updategroupflags", set_flags, clear_flags)
 
 class ModFlags(base.Flags):
+	__slots__ = ()
 	_EXPLAIN = [
 		  None							#1
 		, "Add and remove mods"			#2
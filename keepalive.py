@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+#keepalive.py
+'''
+Manager-wide keepalive. A single timer wheel pings idle connections and closes
+those which stop answering, instead of one sleeping task per connection.
+'''
+from math import ceil
+
+class Keepalive:
+	'''
+	Hashed timer wheel of protocols. Every `resolution` seconds one slot is
+	checked: connections idle for `interval` seconds are pinged, and those
+	that have not received anything `timeout` seconds after a ping are closed.
+	'''
+	def __init__(self, loop, interval=15, timeout=10, resolution=1):
+		if min(interval, timeout, resolution) <= 0:
+			raise ValueError("keepalive times must be positive")
+		self._loop = loop
+		self.interval = interval
+		self.timeout = timeout
+		self._resolution = resolution
+		self._slots = [set() for _ in
+			range(ceil(max(interval, timeout) / resolution) + 1)]
+		self._where = {}		#protocol -> index of slot containing it
+		self._position = 0
+		self._next_tick = 0
+		self._handle = None
+
+	def __len__(self):
+		return len(self._where)
+
+	def __contains__(self, protocol):
+		return protocol in self._where
+
+	def add(self, protocol):
+		'''Start keeping `protocol` alive. Used internally on connection_made'''
+		if self._handle is None:
+			self._next_tick = self._loop.time() + self._resolution
+			self._handle = self._loop.call_at(self._next_tick, self._tick)
+		self._schedule(protocol, self.interval)
+
+	def remove(self, protocol):
+		'''Stop keeping `protocol` alive'''
+		self._unlink(protocol)
+		if not self._where and self._handle is not None:
+			self._handle.cancel()
+			self._handle = None
+
+	def _unlink(self, protocol):
+		index = self._where.pop(protocol, None)
+		if index is not None:
+			self._slots[index].discard(protocol)
+
+	def _schedule(self, protocol, delay):
+		self._unlink(protocol)
+		ticks = min(len(self._slots) - 1, max(1, ceil(delay / self._resolution)))
+		index = (self._position + ticks) % len(self._slots)
+		self._slots[index].add(protocol)
+		self._where[protocol] = index
+
+	def _tick(self):
+		self._position = (self._position + 1) % len(self._slots)
+		due = self._slots[self._position]
+		self._slots[self._position] = set()
+		now = self._loop.time()
+		for protocol in due:
+			del self._where[protocol]
+			delay = self._check(protocol, now)
+			if delay is not None:
+				self._schedule(protocol, delay)
+		if self._where:
+			self._next_tick += self._resolution
+			self._handle = self._loop.call_at(self._next_tick, self._tick)
+		else:
+			self._handle = None
+
+	def _check(self, protocol, now):
+		'''Ping or close `protocol`. Returns seconds until the next check'''
+		transport = protocol._transport
+		if transport is None or transport.is_closing():
+			return None
+		if protocol._ping_sent is not None:
+			waited = now - protocol._ping_sent
+			if waited < self.timeout:
+				return self.timeout - waited
+			#nothing since the ping; the socket is dead
+			transport.abort()
+			return None
+		#traffic in both directions is enough to keep the connection alive
+		idle = now - min(protocol._last_command, protocol._last_write)
+		if idle < self.interval:
+			return self.interval - idle
+		protocol.ping()
+		return self.timeout
@@ -4,33 +4,166 @@
 The manager class and associated helper functions. Provides a single unified
 object to manage all connections and interpret events.
 '''
+import random
 import asyncio
 from socket import gaierror
 from urllib import request
 from os.path import basename
-from functools import partial
 from . import base, group, private, generate
+from .keepalive import Keepalive
+from .resolver import ServerCache
 
-def _connection_lost_handler(loop, context):
-	failed_protocol = context.get("protocol")
-	if isinstance(failed_protocol, base.ChatangoProtocol):
-		loop.create_task(failed_protocol.disconnect(True))
-	else:
-		loop.default_exception_handler(context)
+def new_event_loop(backend="auto"):
+	'''
+	Create an event loop with implementation `backend`: "selector" for the
+	standard library's selector loop, "uvloop" for uvloop (if installed), or
+	"auto" for uvloop if available and the selector loop otherwise
+	'''
+	if backend not in ("auto", "selector", "uvloop"):
+		raise ValueError("unknown event loop backend " + repr(backend))
+	if backend != "selector":
+		try:
+			import uvloop
+			return uvloop.new_event_loop()
+		except ImportError as exc:
+			if backend == "uvloop":
+				raise ValueError("uvloop backend requested but uvloop is not "\
+					"installed") from exc
+	return asyncio.SelectorEventLoop()
+
+def _install_exception_handler(loop):
+	'''
+	Disconnect protocols which raise errors in `loop`. Other errors are passed
+	to the handler which was installed before, or the default handler
+	'''
+	previous = loop.get_exception_handler()
+	if getattr(previous, "_chatango", False):
+		return
+	def handler(loop, context):
+		failed_protocol = context.get("protocol")
+		if isinstance(failed_protocol, base.ChatangoProtocol):
+			loop.create_task(failed_protocol.disconnect(True))
+		elif previous is not None:
+			previous(loop, context)
+		else:
+			loop.default_exception_handler(context)
+	handler._chatango = True
+	loop.set_exception_handler(handler)
 
 def get_anon(name):
 	if name.find("anon") == 0 and len(name) == 8 and name[4:].isdigit():
 		return int(name[4:])
 	return None
 
+class ReconnectPolicy:
+	'''
+	Jittered exponential backoff for reconnecting to groups. The n-th attempt
+	waits `base_delay * factor**n` seconds, up to `max_delay`, less a random
+	fraction of at most `jitter`. If `max_attempts` is None, retry forever.
+	'''
+	def __init__(self, base_delay=1, factor=2, max_delay=60, jitter=0.5
+	, max_attempts=None):
+		self.base_delay = base_delay
+		self.factor = factor
+		self.max_delay = max_delay
+		self.jitter = jitter
+		self.max_attempts = max_attempts
+
+	def delays(self, attempt=0):
+		'''
+		Generator of seconds to wait before each attempt, starting from the
+		`attempt`-th
+		'''
+		while self.max_attempts is None or attempt < self.max_attempts:
+			delay = min(self.max_delay, self.base_delay * self.factor**attempt)
+			yield delay * (1 - random.uniform(0, self.jitter))
+			attempt += 1
+
+class GroupRegistry:
+	'''
+	Joined Groups, indexed by lowercase name and by server number.
+	Membership tests accept names or Groups; iteration yields Groups.
+	'''
+	def __init__(self):
+		self._by_name = {}		#name -> Group
+		self._by_server = {}	#server number -> {name: Group}
+
+	def __len__(self):
+		return len(self._by_name)
+
+	def __iter__(self):
+		return iter(self._by_name.values())
+
+	def __contains__(self, item):
+		if isinstance(item, group.Group):
+			return self._by_name.get(item.name.lower()) is item
+		return item.lower() in self._by_name
+
+	def get(self, name, default=None):
+		'''The Group named `name`, or `default`'''
+		return self._by_name.get(name.lower(), default)
+
+	def add(self, group_storage):
+		'''Add a Group. Raises ValueError if the name is already taken'''
+		name = group_storage.name.lower()
+		if name in self._by_name:
+			raise ValueError("group {} already registered".format(name))
+		server = generate.server_num(name)
+		self._by_name[name] = group_storage
+		self._by_server.setdefault(server, {})[name] = group_storage
+
+	def pop(self, name, default=None):
+		'''Remove and return the Group named `name` (or a Group), or `default`'''
+		if isinstance(name, group.Group):
+			name = name.name
+		name = name.lower()
+		ret = self._by_name.pop(name, None)
+		if ret is None:
+			return default
+		server = generate.server_num(name)
+		shard = self._by_server[server]
+		del shard[name]
+		if not shard:
+			del self._by_server[server]
+		return ret
+
+	def clear(self):
+		self._by_name.clear()
+		self._by_server.clear()
+
+	def by_server(self):
+		'''Iterate over 2-tuples of server number and a list of its Groups'''
+		for server, groups in self._by_server.items():
+			yield server, list(groups.values())
+
 class Manager:
 	'''
 	Creates and manages connections to Chatango.
 	Also propagates events from joined groups
 	'''
-	def __init__(self, username: str, password: str, pm=False, loop=None):
-		self.loop = asyncio.get_event_loop() if loop is None else loop
-		self._groups = []
+	def __init__(self, username: str, password: str, pm=False, loop=None
+	, ping_interval=15, ping_timeout=10, reconnect=None, server_cache=None
+	, loop_backend=None, archive=None):
+		#`loop_backend` creates a new loop (see new_event_loop) if `loop` is None
+		if loop is None:
+			loop = asyncio.get_event_loop() if loop_backend is None \
+				else new_event_loop(loop_backend)
+		self.loop = loop
+		self._groups = GroupRegistry()
+		#ReconnectPolicy for groups whose connection drops, or None
+		self.reconnect = reconnect
+		#resolved group server addresses; can be shared between Managers
+		self.server_cache = ServerCache(self.loop) if server_cache is None \
+			else server_cache
+		#pings connections idle for `ping_interval` seconds and drops those
+		#that haven't answered within `ping_timeout`
+		self._keepalive = Keepalive(self.loop, ping_interval, ping_timeout)
+		#Archive storing every post received, or None
+		self.archive = archive
+		#event handlers added with add_event
+		self._handlers = {}				#event name -> [(-priority, order, func)]
+		self._dispatch = {}				#event name -> tuple of handlers to call
+		self._handler_order = 0
 		self.privates = None
 		if pm:
 			self.loop.create_task(self.join_pm())
@@ -42,7 +175,7 @@ class Manager:
 			self.username = username
 			self.password = password
 
-		self.loop.set_exception_handler(_connection_lost_handler)
+		_install_exception_handler(self.loop)
 
 	def __del__(self):
 		self.stop()
@@ -77,23 +210,43 @@ class Manager:
 			return
 		self.loop.run_until_complete(self.leave_all())
 
-	@classmethod
-	def add_event(cls, eventname, func):
+	def add_event(self, eventname, func, priority=0):
 		'''
-		Add an event handler.
-		`func` should have a keyword arg `ancestor`, the previous event handler
+		Subscribe `func` to event `eventname` on this Manager. `func` is called
+		with the Connection the event occurred on and the event's arguments,
+		and can be a function or coroutine function. Handlers with a higher
+		`priority` run first; ties run in the order they were added, after any
+		method of the same name defined on the class.
 		'''
-		ancestor = None
 		#limit modifiable attributes
 		if not eventname.startswith("on"):
 			raise ValueError("eventname must start with 'on'")
-		try:
-			ancestor = getattr(cls, eventname)
-		except AttributeError:
-			pass
-		#should be a partially applied function with
-		#the event ancestor (a coroutine generator)
-		setattr(cls, eventname, partial(func, ancestor=ancestor))
+		self._handler_order += 1
+		self._handlers.setdefault(eventname, []).append(
+			(-priority, self._handler_order, func))
+		self._dispatch.pop(eventname, None)
+
+	def remove_event(self, eventname, func):
+		'''Unsubscribe `func` from event `eventname`. Returns success'''
+		handlers = self._handlers.get(eventname, [])
+		for index, (_, _, handler) in enumerate(handlers):
+			if handler == func:
+				del handlers[index]
+				self._dispatch.pop(eventname, None)
+				return True
+		return False
+
+	def _get_handlers(self, eventname):
+		'''Tuple of handlers for `eventname`, in call order'''
+		ret = self._dispatch.get(eventname)
+		if ret is None:
+			handlers = list(self._handlers.get(eventname, ()))
+			method = getattr(self, eventname, None)
+			if method is not None:
+				handlers.append((0, 0, method))
+			handlers.sort(key=lambda handler: handler[:2])
+			ret = self._dispatch[eventname] = tuple(i[2] for i in handlers)
+		return ret
 
 	async def join_group(self, group_name: str, port=443):
 		'''(Coro) Join group `group_name`'''
@@ -104,30 +257,128 @@ class Manager:
 
 		#already joined group
 		if group_name != self.username and group_name not in self._groups:
+			ret = group.GroupProtocol(group_name, self, port=port)
+			if self._aid is not None:
+				ret._storage.set_anon(self._aid)
+			#reserve the name, so concurrent joins of the same group fail
+			self._groups.add(ret._storage)
 			try:
-				ret = group.GroupProtocol(group_name, self)
-				if self._aid is not None:
-					ret._storage.set_anon(self._aid)
-				await self.loop.create_connection(lambda: ret,
-					"s{}.chatango.com".format(server), port)
-				self._groups.append(ret._storage)
-				return ret._storage
-			except gaierror as exc:
-				raise ConnectionError("could not connect to group server") \
-				from exc
+				await self._connect_group(ret)
+			except BaseException as exc:
+				if ret._storage in self._groups:
+					self._groups.pop(group_name)
+				if isinstance(exc, gaierror):
+					raise ConnectionError("could not connect to group server") \
+					from exc
+				raise
+			if ret._storage not in self._groups:
+				self._close_left(ret)
+				raise ConnectionError("group left while joining")
+			return ret._storage
 		elif self.username and group_name == self.username:
 			return await self.join_pm()
 		else:
 			raise ValueError("attempted to join group multiple times")
 
+	async def _connect_group(self, protocol):
+		'''(Coro) Open the connection for GroupProtocol `protocol`'''
+		server = generate.server_num(protocol._storage._name)
+		address = await self.server_cache.resolve(server, protocol._port)
+		await self.loop.create_connection(lambda: protocol, address
+			, protocol._port)
+
+	async def _reconnect(self, old):
+		'''
+		(Coro) Replace the lost GroupProtocol `old` with a new one for the
+		same Group, waiting between attempts according to `reconnect`
+		'''
+		storage = old._storage
+		#connections dropped before catching up don't start the backoff over
+		for delay in self.reconnect.delays(storage._reconnect_attempts):
+			storage._reconnect_attempts += 1
+			await asyncio.sleep(delay)
+			if storage not in self._groups:
+				return
+			ret = group.GroupProtocol(storage._name, self, port=old._port
+				, storage=storage)
+			ret._resume(old)
+			try:
+				await self._connect_group(ret)
+			except OSError:
+				continue
+			except Exception as exc:
+				self.loop.call_exception_handler({
+					  "message": "reconnecting to {} failed".format(storage._name)
+					, "exception": exc
+				})
+				break
+			if storage not in self._groups:
+				self._close_left(ret)
+			return
+		old._call_event("on_reconnect_failed")
+
+	@staticmethod
+	def _close_left(protocol):
+		'''
+		Close the connection of a group that was left while it was connecting.
+		leave_group has already disconnected it, so no events are fired
+		'''
+		protocol.connected = False
+		protocol._transport.close()
+
+	async def join_many(self, group_names, concurrency=16, stagger=0.5
+	, timeout=30):
+		'''
+		(Coro) Join all groups in `group_names`, with at most `concurrency`
+		connections in progress at a time. Connections to the same server are
+		started at least `stagger` seconds apart. Each join waits up to
+		`timeout` seconds for the group to be ready.
+		Returns a dict of group names to either the joined Group or the
+		exception that prevented joining it.
+		'''
+		names = list(dict.fromkeys(name.lower() for name in group_names))
+		semaphore = asyncio.Semaphore(concurrency)
+		next_start = {}		#server number -> earliest time to connect to it
+
+		async def join(group_name):
+			try:
+				server = generate.server_num(group_name)
+			except ValueError as exc:
+				return exc
+			now = self.loop.time()
+			start = max(now, next_start.get(server, now))
+			next_start[server] = start + stagger
+			if start > now:
+				await asyncio.sleep(start - now)
+			async with semaphore:
+				try:
+					ret = await self.join_group(group_name)
+				#any failure is this group's result, not the whole call's
+				except Exception as exc:
+					return exc
+				try:
+					await asyncio.wait_for(ret.ready, timeout)
+				except asyncio.TimeoutError as exc:
+					await self.leave_group(ret)
+					return exc
+				return ret
+
+		results = await asyncio.gather(*map(join, names))
+		return dict(zip(names, results))
+
 	async def leave_group(self, group_name):
 		'''(Coro) Leave group `group_name`'''
-		if isinstance(group_name, group.Group):
-			group_name = group_name.name
-		for index, gro in enumerate(self._groups):
-			if gro.name == group_name:
-				await gro._protocol.disconnect()
-				self._groups.pop(index)
+		gro = self._groups.pop(group_name)
+		if gro is not None:
+			await gro._protocol.disconnect()
+
+	def get_group(self, group_name):
+		'''Return the joined Group named `group_name`, or None'''
+		return self._groups.get(group_name)
+
+	def groups_by_server(self):
+		'''Iterate over 2-tuples of server number and a list of its joined Groups'''
+		return self._groups.by_server()
 
 	async def join_pm(self, port=5222):
 		'''(Coro) Log into private messages and return Connection'''
@@ -150,10 +401,13 @@ class Manager:
 
 	async def leave_all(self):
 		'''(Coro) Disconnect from all groups and PMs'''
-		for gro in self._groups:
-			await gro._protocol.disconnect()
+		groups = list(self._groups)
 		self._groups.clear()
+		for gro in groups:
+			await gro._protocol.disconnect()
 		await self.leave_pm()
+		if self.archive is not None:
+			self.archive.flush()
 
 	def upload_avatar(self, location):
 		'''Upload an avatar with path `location`'''
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#pairing.py
+'''
+Matching of group posts (`b`) with the unids that arrive for them in `u`.
+Either half can arrive first; halves that never find a partner are evicted by
+age and by count, so they can't pile up on long-lived connections.
+'''
+from collections import OrderedDict
+
+#what to do with a post whose unid never arrived
+PAIRING_EMIT = 0	#deliver it with unid None
+PAIRING_DROP = 1	#forget it
+
+class PairingBuffer:
+	'''
+	Buffer of unmatched posts and unids, keyed by post number. Matched posts
+	are passed to `deliver`. Entries older than `max_age` seconds, or the
+	oldest beyond `max_size` of each kind, are expired according to `policy`.
+	'''
+	def __init__(self, loop, deliver, max_size=256, max_age=30
+	, policy=PAIRING_EMIT):
+		self._loop = loop
+		self._deliver = deliver
+		self.max_size = max_size
+		self.max_age = max_age
+		self.policy = policy
+		self._posts = OrderedDict()		#pnum -> (time added, Post)
+		self._unids = OrderedDict()		#pnum -> (time added, unid)
+		self._expire_handle = None
+		#statistics
+		self._matched = 0
+		self._expired = 0
+		self._total_latency = 0
+		self._max_latency = 0
+
+	pending = property(lambda self: len(self._posts) + len(self._unids)
+		, doc="Number of posts and unids waiting for their other half")
+	matched = property(lambda self: self._matched
+		, doc="Number of posts paired with their unid")
+	expired = property(lambda self: self._expired
+		, doc="Number of posts and unids evicted without a partner")
+	max_latency = property(lambda self: self._max_latency
+		, doc="Longest time in seconds between the halves of a pair")
+	@property
+	def average_latency(self):
+		'''Mean time in seconds between the halves of a pair'''
+		return self._total_latency / self._matched if self._matched else 0
+
+	def add_post(self, post):
+		'''Add a post from `b`. Delivered at once if its unid has arrived'''
+		now = self._loop.time()
+		entry = self._unids.pop(post.pnum, None)
+		if entry is not None:
+			post.unid = entry[1]
+			self._match(now - entry[0], post)
+			return
+		self._posts[post.pnum] = (now, post)
+		self._evict(now)
+
+	def add_unid(self, pnum, unid):
+		'''Add a unid from `u`. Delivers its post if that has arrived'''
+		now = self._loop.time()
+		entry = self._posts.pop(pnum, None)
+		if entry is not None:
+			entry[1].unid = unid
+			self._match(now - entry[0], entry[1])
+			return
+		self._unids[pnum] = (now, unid)
+		self._evict(now)
+
+	def clear(self):
+		'''Forget all unmatched entries. Used internally on connection lost'''
+		self._posts.clear()
+		self._unids.clear()
+		if self._expire_handle is not None:
+			self._expire_handle.cancel()
+			self._expire_handle = None
+
+	def _match(self, latency, post):
+		self._matched += 1
+		self._total_latency += latency
+		self._max_latency = max(self._max_latency, latency)
+		self._deliver(post)
+
+	def _evict(self, now):
+		'''Expire old and excess entries, and wake up when the next ages out'''
+		deadline = now - self.max_age
+		for entries in (self._posts, self._unids):
+			while entries:
+				pnum, (added, value) = next(iter(entries.items()))
+				if added > deadline and len(entries) <= self.max_size:
+					break
+				del entries[pnum]
+				self._expired += 1
+				if entries is self._posts and self.policy == PAIRING_EMIT:
+					self._deliver(value)
+		#a wakeup already pending runs no later than the new oldest entry needs
+		if self._expire_handle is not None:
+			return
+		oldest = min((next(iter(entries.values()))[0]
+			for entries in (self._posts, self._unids) if entries), default=None)
+		if oldest is not None:
+			self._expire_handle = self._loop.call_at(oldest + self.max_age
+				, self._expire)
+
+	def _expire(self):
+		self._expire_handle = None
+		self._evict(self._loop.time())
@@ -5,7 +5,9 @@ Post formatting classes. Takes data received from chatango and formats HTML
 out, makes formatting easily accessible, and provides mod interfaces.
 '''
 import re
+import sys
 import html
+from functools import lru_cache
 from . import generate, base
 
 POST_TAG_RE = re.compile("(<n([a-fA-F0-9]{1,6})\\/>)?" \
@@ -34,7 +36,15 @@ def parse_formatting(raw):
 			f_face = base.FONT_FACES[0]
 		except ValueError: #conversion failed, literal font name
 			pass
-	return n_color, f_color, f_size, f_face
+	return shared_format(n_color, f_color, f_size, f_face)
+
+@lru_cache(maxsize=4096)
+def shared_format(n_color, f_color, f_size, f_face):
+	'''
+	Shared (n_color, f_color, f_size, f_face) tuple. Posts with the same
+	formatting refer to one tuple instead of four strings each
+	'''
+	return (sys.intern(n_color), sys.intern(f_color), f_size, sys.intern(f_face))
 
 def format_raw(raw):
 	'''
@@ -64,14 +74,30 @@ def format_raw(raw):
 class Post:
 	'''
 	Objects that represent messages in chatango
-	Post objects have support for channels and formatting parsing
+	Post objects have support for channels and formatting parsing.
+	Attributes that don't apply to a kind of post (e.g. `unid` of a private
+	message) are left unset
 	'''
+	__slots__ = ("time", "post", "group", "user", "session_id", "mod_id"
+		, "unid", "pnum", "ip", "mentions", "channel", "badge", "duration"
+		, "enabled", "_format")
 	def __init__(self, time: float, post: str, group: base.Connection
-	, **kwargs):
+	, n_color='', f_color='', f_size=11, f_face=base.FONT_FACES[0], **kwargs):
 		self.time = time
 		self.post = format_raw(post)
 		self.group = group
-		self.__dict__.update(kwargs)
+		self._format = shared_format(n_color, f_color, f_size, f_face)
+		for key, value in kwargs.items():
+			setattr(self, key, value)
+
+	n_color = property(lambda self: self._format[0]
+		, doc="Name color")
+	f_color = property(lambda self: self._format[1]
+		, doc="Font color")
+	f_size = property(lambda self: self._format[2]
+		, doc="Font size")
+	f_face = property(lambda self: self._format[3]
+		, doc="Font face")
 
 	def __eq__(self, other):
 		if not hasattr(self, "unid"):
@@ -82,8 +108,7 @@ class Post:
 
 	@classmethod
 	def _base(cls, group: base.Connection, raw):
-		n_color, f_color, f_size, f_face = \
-			parse_formatting(raw[9])
+		formatting = parse_formatting(raw[9])
 
 		message = ':'.join(raw[9:])
 
@@ -93,22 +118,15 @@ class Post:
 			if raw[2]: #temp name
 				user = '#' + raw[2]
 			else:
-				user = "!anon" + generate.aid(n_color, raw[3])
+				user = "!anon" + generate.aid(formatting[0], raw[3])
 			#n_color doesn't count for anons, because it changes their number
-			n_color = ''
-		else:
-			for group_user in group._users:
-				if session_id in group_user.sessions:
-					user = user
-					break
+			formatting = ('',) + formatting[1:]
+		user = sys.intern(user)
 
+		members = group._members
 		mentions = set()
 		for mention in REPLY_RE.findall(message):
-			for group_user in group._users:
-				if group_user == mention:
-					mention = group_user
-					break
-			mentions.add(mention)
+			mentions.add(members.get(mention) or mention)
 
 		channels_and_badge = int(raw[7])
 		#magic that turns no badge into 0, mod badge into 1, and staff badge into 2
@@ -118,10 +136,9 @@ class Post:
 		channel = (channels_and_badge >> 8) & 31
 		channel = channel&1|((channel&8)>>2)|((channel&16)>>3)
 
-		return cls(float(raw[0]), message, group, user=user, session_id=session_id
-			, mod_id=raw[4], unid=None, pnum=None, ip=raw[6]
-			, mentions=mentions, channel=channel, badge=badge
-			, n_color=n_color, f_color=f_color, f_size=f_size, f_face=f_face)
+		return cls(float(raw[0]), message, group, *formatting, user=user
+			, session_id=session_id, mod_id=raw[4], unid=None, pnum=None
+			, ip=raw[6], mentions=mentions, channel=channel, badge=badge)
 
 	@classmethod
 	def normal(cls, group: base.Connection, raw):
@@ -151,22 +168,18 @@ class Post:
 			4: the message
 		'''
 		startmsg = 2 if not mod else 4
-		n_color, f_color, f_size, f_face = \
-			parse_formatting(raw[startmsg])
 		ret = cls(0, ':'.join(raw[startmsg:]), group
-			, user=group.name, duration=None, enabled=None
-			, n_color=n_color, f_color=f_color, f_size=f_size, f_face=f_face)
+			, *parse_formatting(raw[startmsg])
+			, user=group.name, duration=None, enabled=None)
 		if mod:
 			ret.enabled = bool(int(raw[0]))
 			ret.duration = int(raw[3])
+		return ret
 
 	@classmethod
 	def private(cls, group: base.Connection, raw):
-		n_color, f_color, f_size, f_face = \
-			parse_formatting(raw[5])
 		return cls(float(raw[3]), ':'.join(raw[5:]), group
-			, user=raw[0]
-			, n_color=n_color, f_color=f_color, f_size=f_size, f_face=f_face)
+			, *parse_formatting(raw[5]), user=sys.intern(raw[0]))
 
 	def delete(self):
 		'''Sugar for group.delete(self)'''
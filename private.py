@@ -46,26 +46,25 @@ class PMProtocol(base.ChatangoProtocol):
 		super().connection_made(transport)
 		self.send_command("tlogin", self.auth_key, self._session_id, firstcmd=True)
 
-	async def _recv_seller_name(self, *args):
+	def _recv_seller_name(self, *args):
 		#seller_name returns two arguments: the session id called with tlogin and
 		#the username; neither of these are important except as a sanity check
 		pass
 
-	async def _recv_OK(self, _):
+	def _recv_OK(self, _):
 		self._call_event("on_pm_connect")
 		self.send_command("settings")
 		self.send_send_cnd("wl")	#friends list
-		self._ping_task = self._loop.create_task(self.ping())
 
-	async def _recv_msg(self, args):
+	def _recv_msg(self, args):
 		post = Post.private(self._storage, args)
 		self._call_event("on_pm", post, False)
 
-	async def _recv_msgoff(self, args):
+	def _recv_msgoff(self, args):
 		post = Post.private(self._storage, args)
 		self._call_event("on_pm", post, True)
 
-	async def _recv_wl(self, args):
+	def _recv_wl(self, args):
 		'''Received friends list (watch list)'''
 		self._storage._watchList = {}
 		it = iter(args)
@@ -80,7 +79,7 @@ class PMProtocol(base.ChatangoProtocol):
 			pass
 		self._call_event("on_watchlist")
 
-	async def _recv_track(self, args):
+	def _recv_track(self, args):
 		'''Received tracked user'''
 		#0: username
 		#1: time last online
@@ -89,14 +88,14 @@ class PMProtocol(base.ChatangoProtocol):
 		track[args[0]] = (float(args[1]), args[2])
 		self._call_event("on_track")
 
-	async def _recv_connect(self, args):
+	def _recv_connect(self, args):
 		'''Received check online'''
 		#TODO
 		#0:	username
 		#1:	last message time
 		#2:	online/offline/app/invalid (not a real person or is a group)
 
-	async def _recv_wladd(self, args):
+	def _recv_wladd(self, args):
 		'''Received addition to watch list'''
 		#0:	username
 		#1:	online/offline/app
@@ -106,7 +105,7 @@ class PMProtocol(base.ChatangoProtocol):
 			, args[1])
 		self._call_event("on_watchlist_update")
 
-	async def _recv_wldelete(self, args):
+	def _recv_wldelete(self, args):
 		'''Received deletion from watch list'''
 		#0:	username
 		#1:	'deleted'
@@ -115,7 +114,7 @@ class PMProtocol(base.ChatangoProtocol):
 			del self._storage._watchList[args[0]]
 		self._call_event("on_watchlist_update")
 
-	async def _recv_status(self, args):
+	def _recv_status(self, args):
 		'''Received status update'''
 		#0: username
 		#1: last time online
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#resolver.py
+'''
+Address cache for chatango's numbered group servers, so that joins and
+reconnects don't wait on the system resolver.
+'''
+import json
+import socket
+import asyncio
+
+class ServerCache:
+	'''
+	Cache of addresses for `s{N}.chatango.com`, keyed by server number.
+	Successful lookups are kept for `ttl` seconds and failures for
+	`negative_ttl` seconds. Concurrent lookups of the same server share one
+	query to the resolver.
+	'''
+	_HOST = "s{}.chatango.com"
+
+	def __init__(self, loop, ttl=3600, negative_ttl=30):
+		self._loop = loop
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self._entries = {}		#server number -> (expiry, address or gaierror)
+		self._pending = {}		#server number -> future of lookup in progress
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __contains__(self, server):
+		entry = self._entries.get(server)
+		return entry is not None and entry[0] > self._loop.time()
+
+	def seed(self, server, address, ttl=None):
+		'''
+		Cache `address` for server number `server` for `ttl` seconds (default
+		`self.ttl`). Use `float("inf")` to never expire, e.g. for stubs
+		'''
+		ttl = self.ttl if ttl is None else ttl
+		self._entries[int(server)] = (self._loop.time() + ttl, address)
+
+	def forget(self, server=None):
+		'''Drop the entry for `server`, or all entries if None'''
+		if server is None:
+			self._entries.clear()
+		else:
+			self._entries.pop(server, None)
+
+	def load(self, path, ttl=None):
+		'''Seed the cache from a JSON file mapping server numbers to addresses'''
+		with open(path) as cache_file:
+			for server, address in json.load(cache_file).items():
+				self.seed(server, address, ttl)
+
+	def save(self, path):
+		'''Write all unexpired addresses to a JSON file readable by `load`'''
+		now = self._loop.time()
+		with open(path, "w") as cache_file:
+			json.dump({str(server): address
+				for server, (expiry, address) in self._entries.items()
+				if expiry > now and isinstance(address, str)}, cache_file)
+
+	async def resolve(self, server, port):
+		'''
+		(Coro) Address for server number `server`.
+		Raises socket.gaierror if it could not be resolved
+		'''
+		entry = self._entries.get(server)
+		if entry is not None and entry[0] > self._loop.time():
+			if isinstance(entry[1], socket.gaierror):
+				raise socket.gaierror(*entry[1].args)
+			return entry[1]
+		pending = self._pending.get(server)
+		if pending is None:
+			pending = self._pending[server] = self._loop.create_future()
+			self._loop.create_task(self._lookup(server, port, pending))
+		return await asyncio.shield(pending)
+
+	async def _lookup(self, server, port, future):
+		try:
+			infos = await self._loop.getaddrinfo(self._HOST.format(server), port
+				, type=socket.SOCK_STREAM)
+			address = infos[0][4][0]
+		except socket.gaierror as exc:
+			self._entries[server] = (self._loop.time() + self.negative_ttl, exc)
+			future.set_exception(exc)
+		except OSError as exc:
+			future.set_exception(exc)
+		else:
+			self._entries[server] = (self._loop.time() + self.ttl, address)
+			future.set_result(address)
+		finally:
+			del self._pending[server]
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#scheduler.py
+'''
+Outbound pacing for groups. Posts are held to the rate limit the group
+advertises and back off after flood warnings, while moderation commands are
+allowed to jump ahead of them.
+'''
+from collections import deque
+
+#lanes, in the order they are drained
+PRIORITY_MOD = 0
+PRIORITY_POST = 1
+
+class SendScheduler:
+	'''
+	Token bucket scheduler for commands sent to a group.
+	Lanes are drained lowest number first. Commands in the moderation lane are
+	never paced; all other lanes share one bucket refilled every `interval`
+	seconds, where `interval` is the larger of the group's rate limit and the
+	current flood backoff.
+	'''
+	_LANES = 2
+	_BURST = 1				#tokens the bucket can hold
+	_MIN_BACKOFF = 0.5		#interval after the first flood warning
+	_MAX_BACKOFF = 10
+	_BACKOFF_RESET = 60		#seconds without a warning before backoff clears
+
+	def __init__(self, group):
+		self._group = group
+		self._lanes = [deque() for _ in range(self._LANES)]
+		self._ratelimit = 0
+		self._backoff = 0
+		self._last_warning = 0
+		self._banned_until = 0
+		self._tokens = self._BURST
+		self._refilled = 0
+		self._wakeup = None
+		#statistics
+		self._sent = 0
+		self._total_wait = 0
+		self._max_wait = 0
+
+	interval = property(lambda self: max(self._ratelimit, self._backoff)
+		, doc="Seconds between paced commands. 0 if unpaced")
+	backoff = property(lambda self: self._backoff
+		, doc="Extra pacing in seconds added by flood warnings")
+	depth = property(lambda self: tuple(len(lane) for lane in self._lanes)
+		, doc="Tuple of the number of commands queued in each lane")
+	pending = property(lambda self: sum(len(lane) for lane in self._lanes)
+		, doc="Total number of commands waiting to be sent")
+	sent = property(lambda self: self._sent
+		, doc="Number of commands sent through the scheduler")
+	max_wait = property(lambda self: self._max_wait
+		, doc="Longest time in seconds a command spent queued")
+	@property
+	def average_wait(self):
+		'''Mean time in seconds commands spent queued'''
+		return self._total_wait / self._sent if self._sent else 0
+
+	@property
+	def banned_for(self):
+		'''Seconds remaining in the current flood ban, or 0'''
+		return max(0, self._banned_until - self._loop.time())
+
+	@property
+	def _loop(self):
+		return self._group._protocol._loop
+
+	def submit(self, priority, *args):
+		'''Queue `args` for send_command in lane `priority`'''
+		self._lanes[priority].append((self._loop.time(), args))
+		#a pending wakeup means paced lanes are waiting for a token
+		if self._wakeup is None or priority == PRIORITY_MOD:
+			self._pump()
+
+	def set_ratelimit(self, seconds):
+		'''Pace posts to one per `seconds` seconds. Used on `ratelimitset`'''
+		self._ratelimit = max(0, seconds)
+
+	def flood_warning(self):
+		'''Back off exponentially. Used on `show_fw`'''
+		now = self._loop.time()
+		self._backoff = min(self._MAX_BACKOFF
+			, max(self._MIN_BACKOFF, self._backoff * 2))
+		self._last_warning = now
+		#don't let a full bucket burst right into a ban
+		self._tokens = min(self._tokens, 0)
+		self._refilled = now
+
+	def flood_ban(self, seconds):
+		'''Hold paced lanes for `seconds`. Used on `show_tb` and `tb`'''
+		self.flood_warning()
+		self._banned_until = max(self._banned_until, self._loop.time() + seconds)
+		self._reschedule(self._banned_until)
+
+	def clear(self):
+		'''Drop every queued command and cancel any pending wakeup'''
+		for lane in self._lanes:
+			lane.clear()
+		if self._wakeup is not None:
+			self._wakeup.cancel()
+			self._wakeup = None
+
+	def _take(self, now):
+		'''Take a token. Returns None on success, else when to retry'''
+		if now < self._banned_until:
+			return self._banned_until
+		if self._backoff and now - self._last_warning > self._BACKOFF_RESET:
+			self._backoff = 0
+		interval = self.interval
+		if not interval:
+			return None
+		self._tokens = min(self._BURST
+			, self._tokens + (now - self._refilled) / interval)
+		self._refilled = now
+		if self._tokens >= 1:
+			self._tokens -= 1
+			return None
+		return now + (1 - self._tokens) * interval
+
+	def _reschedule(self, when):
+		if self._wakeup is not None:
+			self._wakeup.cancel()
+		self._wakeup = self._loop.call_at(when, self._pump)
+
+	def _pump(self):
+		if self._wakeup is not None:
+			self._wakeup.cancel()
+			self._wakeup = None
+		now = self._loop.time()
+		protocol = self._group._protocol
+		for priority, lane in enumerate(self._lanes):
+			while lane:
+				if priority != PRIORITY_MOD:
+					retry = self._take(now)
+					if retry is not None:
+						self._reschedule(retry)
+						return
+				queued, args = lane.popleft()
+				wait = now - queued
+				self._sent += 1
+				self._total_wait += wait
+				self._max_wait = max(self._max_wait, wait)
+				protocol.send_command(*args)
@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+#sharding.py
+'''
+Multi-process Manager. Joined groups are split between worker processes, each
+running its own event loop and Manager, and events are sent back over pipes to
+a coordinating Manager in the parent process.
+'''
+import os
+import zlib
+import builtins
+import pickle
+import struct
+import asyncio
+import multiprocessing
+from functools import partial
+from types import MappingProxyType
+
+from . import base
+from .manager import Manager, new_event_loop
+from .group import Group, User, Ban, ModLog
+from .bans import BanStore
+from .post import Post
+
+class WorkerError(Exception):
+	'''
+	Exception raised in a worker process, whose type isn't a builtin one.
+	The message starts with the name of the original type
+	'''
+
+def shard_of(group_name, workers):
+	'''Index of the worker that owns group `group_name`'''
+	return zlib.crc32(group_name.lower().encode()) % workers
+
+class _GroupRef:
+	'''Picklable stand-in for a Group'''
+	__slots__ = ("name",)
+	def __init__(self, name):
+		self.name = name
+
+	def __reduce__(self):
+		return (_GroupRef, (self.name,))
+
+class _ObjectData:
+	'''Picklable stand-in for a Post, Ban or ModLog'''
+	__slots__ = ("cls", "fields")
+	def __init__(self, cls, fields):
+		self.cls = cls
+		self.fields = fields
+
+	def __reduce__(self):
+		return (_ObjectData, (self.cls, self.fields))
+
+class _ErrorData:
+	'''
+	Picklable stand-in for an exception. Only the type name and message are
+	sent, since exceptions can take arguments that don't unpickle
+	'''
+	__slots__ = ("name", "message")
+	def __init__(self, name, message):
+		self.name = name
+		self.message = message
+
+	def __reduce__(self):
+		return (_ErrorData, (self.name, self.message))
+
+	def rebuild(self):
+		'''The builtin exception of the same name, or a WorkerError'''
+		cls = getattr(builtins, self.name, None)
+		if isinstance(cls, type) and issubclass(cls, BaseException):
+			try:
+				return cls(self.message)
+			except Exception:
+				pass
+		return WorkerError("{}: {}".format(self.name, self.message))
+
+#values sent as they are
+_PLAIN = (str, bytes, int, float, type(None), base.Flags)
+
+def _pack(value):
+	'''
+	Replace objects tied to a connection with picklable stand-ins. Raises
+	TypeError for values that can't be sent between processes
+	'''
+	if isinstance(value, _PLAIN):
+		return value
+	if isinstance(value, BaseException):
+		return _ErrorData(type(value).__name__, str(value))
+	if isinstance(value, (Group, RemoteGroup)):
+		return _GroupRef(value.name)
+	if isinstance(value, (Post, Ban, ModLog)):
+		cls = type(value)
+		return _ObjectData(cls, {key: _pack(getattr(value, key))
+			for key in cls.__slots__ if hasattr(value, key)})
+	if isinstance(value, User):
+		return str(value)
+	if isinstance(value, (list, tuple, set, frozenset)):
+		return type(value)(map(_pack, value))
+	if isinstance(value, (dict, MappingProxyType)):
+		return {key: _pack(attr) for key, attr in value.items()}
+	#read-only views and stores; sent as snapshots
+	if isinstance(value, base.SetView):
+		return set(map(_pack, value))
+	if isinstance(value, (base.SequenceView, BanStore)):
+		return list(map(_pack, value))
+	raise TypeError("can't send {} to another process".format(
+		type(value).__name__))
+
+def _unpack(value, resolve):
+	'''Inverse of _pack. `resolve` maps group names to group objects'''
+	if isinstance(value, _GroupRef):
+		return resolve(value.name)
+	if isinstance(value, _ObjectData):
+		ret = value.cls.__new__(value.cls)
+		for key, attr in value.fields.items():
+			setattr(ret, key, _unpack(attr, resolve))
+		return ret
+	if isinstance(value, _ErrorData):
+		return value.rebuild()
+	if isinstance(value, (list, tuple, set, frozenset)):
+		return type(value)(_unpack(i, resolve) for i in value)
+	if isinstance(value, dict):
+		return {key: _unpack(attr, resolve) for key, attr in value.items()}
+	return value
+
+_HEADER = struct.Struct("!I")	#length of each pickled message
+
+class _Channel:
+	'''
+	One end of a pipe, read and written without blocking the event loop.
+	Messages sent in the same loop iteration are written together
+	'''
+	_READ_SIZE = 65536
+	def __init__(self, loop, conn, receive):
+		self._loop = loop
+		self._conn = conn
+		self._fd = conn.fileno()
+		self._receive = receive
+		self._rbuff = bytearray()	#data read, up to an incomplete message
+		self._wbuff = bytearray()	#data waiting for the pipe to take it
+		self._writing = False		#whether waiting for the pipe to be writable
+		self._outbox = []
+		self._flush_handle = None
+		os.set_blocking(self._fd, False)
+		loop.add_reader(self._fd, self._read)
+
+	def send(self, *message):
+		if self._conn.closed:
+			return
+		self._outbox.append(message)
+		if self._flush_handle is None:
+			self._flush_handle = self._loop.call_soon(self._flush)
+
+	def _flush(self):
+		self._flush_handle = None
+		outbox, self._outbox = self._outbox, []
+		for message in outbox:
+			try:
+				data = pickle.dumps(message)
+			except Exception as exc:
+				if message[0] != "result":
+					self._loop.call_exception_handler({
+						  "message": "can't send %r message" % message[0]
+						, "exception": exc
+					})
+					continue
+				#fail the request instead of leaving it waiting
+				data = pickle.dumps(("result", message[1], False, _pack(exc)))
+			self._wbuff += _HEADER.pack(len(data))
+			self._wbuff += data
+		if not self._writing:
+			self._write()
+
+	def _write(self):
+		try:
+			written = os.write(self._fd, self._wbuff)
+		except (BlockingIOError, InterruptedError):
+			written = 0
+		except OSError:
+			#the other end is gone, which reading finds out
+			written = len(self._wbuff)
+		del self._wbuff[:written]
+		if self._wbuff and not self._writing:
+			self._writing = True
+			self._loop.add_writer(self._fd, self._write)
+		elif not self._wbuff and self._writing:
+			self._writing = False
+			self._loop.remove_writer(self._fd)
+
+	def _read(self):
+		try:
+			data = os.read(self._fd, self._READ_SIZE)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			data = b''
+		if not data:
+			#the other end is closed
+			self.close()
+			self._receive("stop")
+			return
+		buffer = self._rbuff
+		buffer += data
+		messages = []
+		start = 0
+		while len(buffer) - start >= _HEADER.size:
+			size, = _HEADER.unpack_from(buffer, start)
+			end = start + _HEADER.size + size
+			if end > len(buffer):
+				break
+			try:
+				messages.append(pickle.loads(buffer[start + _HEADER.size:end]))
+			except Exception as exc:
+				#skip it; the messages after it are whole
+				self._loop.call_exception_handler({
+					  "message": "can't read message from pipe"
+					, "exception": exc
+				})
+			start = end
+		del buffer[:start]
+		for message in messages:
+			self._receive(*message)
+
+	def close(self):
+		'''Close the pipe. Messages still pending are written first'''
+		if self._conn.closed:
+			return
+		if self._flush_handle is not None:
+			self._flush_handle.cancel()
+			self._flush()
+		self._loop.remove_reader(self._fd)
+		if self._writing:
+			self._loop.remove_writer(self._fd)
+			self._writing = False
+		if self._wbuff:
+			#nothing is left to wait on, so wait for the pipe here
+			os.set_blocking(self._fd, True)
+			try:
+				while self._wbuff:
+					del self._wbuff[:os.write(self._fd, self._wbuff)]
+			except OSError:
+				pass
+		self._conn.close()
+
+class _Worker:
+	'''Runs a Manager in a worker process on behalf of a ShardedManager'''
+	def __init__(self, manager, conn):
+		self._manager = manager
+		self._channel = _Channel(manager.loop, conn, self._receive)
+		self._forwarders = {}
+		self.stopped = manager.loop.create_future()
+		for eventname in ("on_connect", "on_reconnect"):
+			manager.add_event(eventname, self._ready)
+		manager.add_event("on_connection_error", self._unready)
+
+	def _ready(self, group):
+		self._channel.send("ready", group.name, True)
+
+	def _unready(self, group, exc):
+		#the group is only waited on again if it will reconnect
+		if self._manager.reconnect is not None:
+			self._channel.send("ready", group.name, False)
+
+	def _forward(self, eventname):
+		'''Handler that sends event `eventname` to the coordinator'''
+		def forward(group, *args):
+			self._channel.send("event", eventname, _pack(group), _pack(args))
+		return forward
+
+	def _receive(self, kind, *args):
+		if kind == "subscribe":
+			eventname = args[0]
+			if eventname not in self._forwarders:
+				self._forwarders[eventname] = self._forward(eventname)
+				self._manager.add_event(eventname, self._forwarders[eventname])
+		elif kind == "join":
+			self._manager.loop.create_task(self._reply(args[0]
+				, self._manager.join_group(args[1], args[2])))
+		elif kind == "leave":
+			self._manager.loop.create_task(self._reply(args[0]
+				, self._manager.leave_group(args[1])))
+		elif kind == "leave_all":
+			self._manager.loop.create_task(self._reply(args[0]
+				, self._manager.leave_all()))
+		elif kind == "call":
+			self._call(*args)
+		elif kind == "stop" and not self.stopped.done():
+			self.stopped.set_result(None)
+
+	async def _reply(self, request_id, coro):
+		try:
+			ret = _pack(await coro)
+		except Exception as exc:
+			self._channel.send("result", request_id, False, _pack(exc))
+		else:
+			self._channel.send("result", request_id, True, ret)
+
+	def _call(self, request_id, group_name, attr, args, kwargs):
+		group = self._manager.get_group(group_name)
+		try:
+			if group is None:
+				raise ValueError("group {} not joined".format(group_name))
+			ret = getattr(group, attr)
+			if callable(ret):
+				ret = ret(*_unpack(args, self._manager.get_group)
+					, **_unpack(kwargs, self._manager.get_group))
+			if request_id is None:
+				return
+			ret = _pack(ret)
+		except Exception as exc:
+			if request_id is not None:
+				self._channel.send("result", request_id, False, _pack(exc))
+			else:
+				#nothing waits on the result, so don't lose the error
+				self._manager.loop.call_exception_handler({
+					  "message": "exception in {}.{}".format(group_name, attr)
+					, "exception": exc
+				})
+			return
+		self._channel.send("result", request_id, True, ret)
+
+	def close(self):
+		self._channel.close()
+
+def _worker_main(conn, username, password, manager_class, kwargs):
+	'''Entry point of worker processes'''
+	backend = kwargs.pop("loop_backend", None)
+	loop = asyncio.new_event_loop() if backend is None \
+		else new_event_loop(backend)
+	asyncio.set_event_loop(loop)
+	manager = manager_class(username, password, loop=loop, **kwargs)
+	worker = _Worker(manager, conn)
+	try:
+		loop.run_until_complete(worker.stopped)
+		loop.run_until_complete(manager.leave_all())
+	finally:
+		worker.close()
+		loop.close()
+
+class RemoteGroup:
+	'''
+	Coordinator-side proxy of a Group owned by a worker process. Public Group
+	methods are forwarded to the worker without waiting; use `call` to await
+	a method's result or `fetch` to read an attribute.
+	'''
+	def __init__(self, manager, name, worker):
+		self._manager = manager
+		self._name = name
+		self._worker = worker
+		#handlers for this group run in order, as for a local Group
+		self._loop = manager.loop
+		self._transport = None
+		self._events = base.EventQueue(self)
+		#mirrors the Group's, as reported by the worker
+		self._ready = asyncio.Event()
+
+	name = property(lambda self: self._name
+		, doc="Name of the group")
+	worker = property(lambda self: self._worker
+		, doc="Index of the worker process the group belongs to")
+	ready = property(lambda self: self._ready.wait()
+		, doc="Awaitable property for when the group is fully connected")
+
+	def __repr__(self):
+		return "{}({})".format(type(self).__name__, repr(self._name))
+
+	def __getattr__(self, attr):
+		if attr.startswith('_') or not callable(getattr(Group, attr, None)):
+			raise AttributeError(attr)
+		return partial(self._manager._send_call, self, None, attr)
+
+	async def call(self, method, *args, **kwargs):
+		'''(Coro) Call Group method `method` in the worker and return its result'''
+		return await self._manager._request(self._worker, "call", self._name
+			, method, _pack(args), _pack(kwargs))
+
+	async def fetch(self, attr):
+		'''(Coro) Value of Group attribute `attr` in the worker'''
+		return await self._manager._request(self._worker, "call", self._name
+			, attr, (), {})
+
+class ShardedManager(Manager):
+	'''
+	Manager which joins groups in `workers` processes (default: one per CPU).
+	Each group is owned by the worker its name hashes to. Events are handled
+	in this process, with RemoteGroups in place of Groups.
+	Extra keyword arguments are passed to `manager_class` in each worker;
+	`loop_backend` selects the event loop of each worker.
+	Private messages aren't sharded, so `pm` must be False; join_pm logs in
+	from this process instead.
+	'''
+	def __init__(self, username: str, password: str, workers=None, loop=None
+	, manager_class=Manager, pm=False, **kwargs):
+		super().__init__(username, password, loop=loop
+			, loop_backend=kwargs.get("loop_backend"))
+		self._remote = {}			#name -> RemoteGroup
+		self._requests = {}			#request id -> (worker index, future)
+		self._request_id = 0
+		self._subscribed = set()
+		self._processes = []
+		self._channels = []
+		if pm:
+			raise ValueError("private messages are not sharded; use join_pm")
+		context = multiprocessing.get_context("spawn")
+		for index in range(workers or os.cpu_count() or 1):
+			parent, child = context.Pipe()
+			process = context.Process(target=_worker_main, daemon=True
+				, args=(child, username, password, manager_class, kwargs))
+			process.start()
+			child.close()
+			self._processes.append(process)
+			self._channels.append(_Channel(self.loop, parent
+				, partial(self._receive, index)))
+		#events with methods defined on the class
+		for name in dir(type(self)):
+			if name.startswith("on_"):
+				self._subscribe(name)
+
+	workers = property(lambda self: len(self._processes)
+		, doc="Number of worker processes")
+
+	def add_event(self, eventname, func, priority=0):
+		'''Subscribe `func` to event `eventname`. See Manager.add_event'''
+		super().add_event(eventname, func, priority)
+		self._subscribe(eventname)
+
+	def _subscribe(self, eventname):
+		if eventname not in self._subscribed:
+			self._subscribed.add(eventname)
+			for channel in self._channels:
+				channel.send("subscribe", eventname)
+
+	def _resolve(self, group_name):
+		ret = self._remote.get(group_name)
+		if ret is None:
+			ret = self._remote[group_name] = RemoteGroup(self, group_name
+				, shard_of(group_name, len(self._channels)))
+		return ret
+
+	def _receive(self, worker, kind, *args):
+		if kind == "event":
+			eventname, group, event_args = args
+			group = _unpack(group, self._resolve)
+			event_args = _unpack(event_args, self._resolve)
+			for func in self._get_handlers(eventname):
+				group._events.put(eventname, func, group, *event_args)
+		elif kind == "ready":
+			group = self._remote.get(args[0])
+			if group is not None:
+				if args[1]:
+					group._ready.set()
+				else:
+					group._ready.clear()
+		elif kind == "result":
+			request_id, success, value = args
+			future = self._requests.pop(request_id, (None, None))[1]
+			if future is None or future.done():
+				return
+			if success:
+				future.set_result(_unpack(value, self._resolve))
+			else:
+				future.set_exception(_unpack(value, self._resolve))
+		elif kind == "stop":
+			#pipe closed; the worker is gone
+			for request_id, (owner, future) in list(self._requests.items()):
+				if owner == worker:
+					del self._requests[request_id]
+					if not future.done():
+						future.set_exception(ConnectionError("worker exited"))
+
+	def _request(self, worker, kind, *args):
+		'''Send a request to `worker` and return a future of its result'''
+		self._request_id += 1
+		future = self.loop.create_future()
+		self._requests[self._request_id] = (worker, future)
+		self._channels[worker].send(kind, self._request_id, *args)
+		return future
+
+	def _send_call(self, group, request_id, attr, *args, **kwargs):
+		self._channels[group.worker].send("call", request_id, group.name, attr
+			, _pack(args), _pack(kwargs))
+
+	def get_group(self, group_name):
+		'''Return the RemoteGroup for joined group `group_name`, or None'''
+		return self._remote.get(group_name.lower()) \
+			if group_name.lower() in self._groups else None
+
+	async def join_group(self, group_name: str, port=443):
+		'''(Coro) Join group `group_name` in the worker that owns it'''
+		group_name = group_name.lower()
+		if group_name in self._groups:
+			raise ValueError("attempted to join group multiple times")
+		ret = self._resolve(group_name)
+		#set by the worker's "ready" once the group has connected
+		ret._ready.clear()
+		self._groups.add(ret)
+		try:
+			await self._request(ret.worker, "join", group_name, port)
+		except BaseException:
+			self._groups.pop(group_name)
+			raise
+		return ret
+
+	async def leave_group(self, group_name):
+		'''(Coro) Leave group `group_name`'''
+		if isinstance(group_name, RemoteGroup):
+			group_name = group_name.name
+		group_name = group_name.lower()
+		if self._groups.pop(group_name) is not None:
+			await self._request(shard_of(group_name, len(self._channels))
+				, "leave", group_name)
+
+	async def leave_all(self):
+		'''(Coro) Disconnect from all groups in all workers, and from PMs'''
+		self._groups.clear()
+		await asyncio.gather(*(self._request(worker, "leave_all")
+			for worker in range(len(self._channels))))
+		await self.leave_pm()
+
+	def stop(self):
+		'''
+		Disconnect from all groups and shut down the worker processes.
+		Blocks until the workers have exited
+		'''
+		if not self._processes:
+			return
+		if not self.loop.is_closed():
+			self.loop.run_until_complete(self.leave_all())
+		for channel in self._channels:
+			channel.send("stop")
+			channel.close()
+		for process in self._processes:
+			process.join()
+		self._processes.clear()
+		self._channels.clear()
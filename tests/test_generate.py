@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+#test_generate.py
+'''
+Differential test of generate.server_num against the float loop it replaced,
+over a large corpus of generated group names
+'''
+import random
+import string
+import unittest
+
+from .. import generate
+
+_ALPHABET = string.ascii_lowercase + string.digits + "-_"
+
+def reference_server_num(group):
+	'''server_num as it was before the binary search'''
+	if group in generate._SPECIALS:
+		return generate._SPECIALS[group]
+	group = group.replace('-', 'q').replace('_', 'q')
+	if not group.isalnum():
+		raise ValueError("invalid character in group name")
+	temp = max(int(group[6:9], 36), 1000) if len(group) >= 7 else 1000
+	max_weight = int(group[:5], 36) % temp
+	total = 0
+	for ret, weight in generate._WEIGHTS:
+		total += weight*temp / generate._TOTAL_WEIGHT
+		if total >= max_weight:
+			return ret
+	return -1
+
+class TestServerNum(unittest.TestCase):
+	CORPUS = 200000
+
+	def assert_same(self, names):
+		server_num = generate.server_num.__wrapped__
+		for name in names:
+			self.assertEqual(server_num(name), reference_server_num(name)
+				, "server_num differs for " + repr(name))
+
+	def test_specials(self):
+		self.assert_same(generate._SPECIALS)
+
+	def test_random_names(self):
+		rand = random.Random(1234)
+		self.assert_same(''.join(rand.choices(_ALPHABET
+			, k=rand.randint(1, 20))) for _ in range(self.CORPUS))
+
+	def test_every_temp(self):
+		#the 7th to 9th characters of a name choose temp; try each one
+		rand = random.Random(5678)
+		self.assert_same(''.join(rand.choices(_ALPHABET, k=6))
+			+ _base36(temp).rjust(3, '0') for temp in range(1000, 36**3))
+
+	def test_cached_matches_uncached(self):
+		names = ["somegroup", "a", "ab-cd_ef12"]
+		self.assertEqual(generate.server_nums(names)
+			, [reference_server_num(name) for name in names])
+
+	def test_invalid_name(self):
+		with self.assertRaises(ValueError):
+			generate.server_num("no spaces")
+
+def _base36(number):
+	digits = []
+	while True:
+		number, digit = divmod(number, 36)
+		digits.append(_ALPHABET[26 + digit] if digit < 10
+			else _ALPHABET[digit - 10])
+		if not number:
+			return ''.join(reversed(digits))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#wordfilter.py
+'''
+Matching of a group's banned words. All words are found in a single pass over
+the text with an Aho-Corasick automaton, so checking a post doesn't depend on
+the number of banned words.
+'''
+import re
+
+WORD_START_RE = re.compile(r"\S*$")
+WORD_END_RE = re.compile(r"\S*")
+
+class BannedWords:
+	'''
+	Case-insensitive matcher of partially banned words (only the match is
+	censored) and totally banned words (the whole word containing the match is
+	censored). The automaton is rebuilt on the first use after `update`
+	'''
+	def __init__(self, parts=(), words=()):
+		self._patterns = []		#(lowercase word, whether total)
+		self._goto = None		#state -> {char: state}; None when out of date
+		self._fail = None
+		self._out = None		#state -> indices into _patterns ending there
+		self.update(parts, words)
+
+	def __len__(self):
+		return len(self._patterns)
+
+	def update(self, parts=(), words=()):
+		'''Replace the banned words. Empty words are ignored'''
+		patterns = {}
+		for word in parts:
+			if word:
+				patterns.setdefault(word.lower(), False)
+		for word in words:
+			if word:
+				patterns[word.lower()] = True
+		self._patterns = list(patterns.items())
+		self._goto = None
+
+	def _build(self):
+		goto, out = [{}], [[]]
+		for index, (word, _) in enumerate(self._patterns):
+			state = 0
+			for char in word:
+				nxt = goto[state].get(char)
+				if nxt is None:
+					nxt = goto[state][char] = len(goto)
+					goto.append({})
+					out.append([])
+				state = nxt
+			out[state].append(index)
+		#breadth-first, so failure links point to finished states
+		fail = [0] * len(goto)
+		queue = list(goto[0].values())
+		for state in queue:
+			for char, nxt in goto[state].items():
+				queue.append(nxt)
+				back = fail[state]
+				while back and char not in goto[back]:
+					back = fail[back]
+				target = goto[back].get(char, 0)
+				#children of the root fail back to it
+				fail[nxt] = target if target != nxt else 0
+				out[nxt] = out[nxt] + out[fail[nxt]]
+		self._goto, self._fail, self._out = goto, fail, out
+
+	def find(self, text):
+		'''
+		List of 3-tuples of start index, end index and banned word for each
+		match in `text`, in order of where they end
+		'''
+		if not self._patterns:
+			return []
+		if self._goto is None:
+			self._build()
+		goto, fail, out, patterns = self._goto, self._fail, self._out \
+			, self._patterns
+		lowered = text.lower()
+		if len(lowered) != len(text):
+			#some characters lowercase to several; keep indices aligned
+			lowered = ''.join(char if len(char.lower()) != 1 else char.lower()
+				for char in text)
+		ret = []
+		state = 0
+		for end, char in enumerate(lowered, 1):
+			while state and char not in goto[state]:
+				state = fail[state]
+			state = goto[state].get(char, 0)
+			for index in out[state]:
+				word = patterns[index][0]
+				ret.append((end - len(word), end, word))
+		return ret
+
+	def mask(self, text):
+		'''
+		`text` censored the way the server does it: partially banned words are
+		replaced with '*', and words containing totally banned words become '*'
+		'''
+		spans = []
+		total = {word for word, is_total in self._patterns if is_total}
+		for start, end, word in self.find(text):
+			if word in total:
+				#widen to the whole word
+				start = WORD_START_RE.search(text, 0, start).start()
+				end = WORD_END_RE.match(text, end).end()
+			spans.append((start, end))
+		if not spans:
+			return text
+		spans.sort()
+		ret = []
+		last = 0
+		for start, end in spans:
+			if start < last:
+				#overlaps the previous censored span
+				if end > last:
+					last = end
+				continue
+			ret.append(text[last:start])
+			ret.append('*')
+			last = end
+		ret.append(text[last:])
+		return ''.join(ret)